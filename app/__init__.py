@@ -8,10 +8,20 @@ from flask_login import LoginManager
 from flask_pagedown import PageDown
 
 from config import config
-
+from .cache import AppCache
+from .mail_queue import MailQueue
+from .page_cache import PageCache
+from .presence import LastSeenBuffer
+from .query_stats import QueryStats
+from .sampling import SamplingProfiler
+from .templating import init_templates
+from .timing import RequestTiming
+from .trending import TrendingCompactor
 
 bootstrap = Bootstrap()
 mail = Mail()
+# sends the mail of the whole app over a few reused SMTP sessions
+mail_queue = MailQueue()
 moment = Moment()
 db = SQLAlchemy()
 login_manager = LoginManager()
@@ -20,6 +30,28 @@ login_manager = LoginManager()
 login_manager.login_view = "auth.login"
 # wrapper for markdown to html converter implemented in js (client-side)
 pagedown = PageDown()
+# batches the last_seen updates done by User.ping()
+last_seen_buffer = LastSeenBuffer()
+# snapshots of logged in users, saves load_user its queries
+user_cache = AppCache("IBLOG_USER_CACHE")
+# rendered post and comment bodies, keyed by their content
+render_cache = AppCache("IBLOG_RENDER_CACHE")
+# recently verified API email and password pairs
+credential_cache = AppCache("IBLOG_CREDENTIAL_CACHE")
+# current token_generation of the users of stateless API tokens
+token_generation_cache = AppCache("IBLOG_TOKEN_GENERATION_CACHE")
+# rendered <li> of posts and comments, see fragments.py
+fragment_cache = AppCache("IBLOG_FRAGMENT_CACHE")
+# queries run by this worker, grouped by fingerprint
+query_stats = QueryStats()
+# profiles the requests an admin asked for
+sampling_profiler = SamplingProfiler()
+# opt-in Server-Timing breakdown of every request
+request_timing = RequestTiming()
+# whole pages served to anonymous users
+page_cache = PageCache()
+# periodically recomputes the trending post scores
+trending_compactor = TrendingCompactor()
 
 
 def create_app(config_name):
@@ -35,10 +67,22 @@ def create_app(config_name):
 
     bootstrap.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app)
     moment.init_app(app)
     db.init_app(app)
     login_manager.init_app(app)
     pagedown.init_app(app)
+    last_seen_buffer.init_app(app)
+    user_cache.init_app(app)
+    render_cache.init_app(app)
+    credential_cache.init_app(app)
+    token_generation_cache.init_app(app)
+    fragment_cache.init_app(app)
+    page_cache.init_app(app)
+    request_timing.init_app(app)
+    query_stats.init_app(app)
+    sampling_profiler.init_app(app)
+    trending_compactor.init_app(app)
 
     # attach routes and custom error pages here
     from .main import main as main_blueprint
@@ -51,4 +95,6 @@ def create_app(config_name):
     # all the routes to this blueprint have prefix /api/v1
     app.register_blueprint(api_blueprint, url_prefix="/api/v1")
 
+    init_templates(app)
+
     return app
@@ -7,4 +7,4 @@ api = Blueprint("api", __name__)
 # routes and other handlers are registered
 # these modules need to import the api blueprint referenced here
 # so they're put at the bottom to prevent circular dependencies
-from . import authentication, posts, users, comments, errors  # noqa
+from . import authentication, posts, users, comments, search, batch, errors  # noqa
@@ -1,5 +1,9 @@
-from flask import g, jsonify
+import hashlib
+import hmac
+
+from flask import current_app, g, jsonify
 from flask_httpauth import HTTPBasicAuth
+from .. import credential_cache
 from ..models import User
 from .errors import unauthorized, forbidden
 from . import api
@@ -25,7 +29,33 @@ def verify_password(email_or_token, password):
         return False
     g.current_user = user
     g.token_used = False
-    return user.verify_password(password)
+    return check_credentials(user, password)
+
+
+def check_credentials(user, password):
+    """
+    user.verify_password() behind a short lived cache of verified
+    credentials, so scripted clients sending the same email and password
+    with every request don't pay for the slow password hash each time
+    - the key is an HMAC of the email, the password and the current
+        password hash, plain passwords are never kept in memory
+    - changing the password changes the hash, which invalidates the
+        cached entries of the old password immediately
+    - without a SECRET_KEY to key the HMAC nothing is cached
+    """
+    secret = current_app.config["SECRET_KEY"]
+    if not secret:
+        return user.verify_password(password)
+    if isinstance(secret, str):
+        secret = secret.encode("utf-8")
+    message = "\0".join([user.email, password, user.password_hash or ""])
+    key = hmac.new(secret, message.encode("utf-8"), hashlib.sha256).hexdigest()
+    if credential_cache.get(key) == user.id:
+        return True
+    if not user.verify_password(password):
+        return False
+    credential_cache.set(key, user.id)
+    return True
 
 
 @auth.error_handler
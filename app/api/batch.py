@@ -0,0 +1,134 @@
+import logging
+
+from flask import current_app, jsonify, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+from . import api
+from .. import db
+from ..exceptions import ValidationError
+from ..models import Comment, Post, User
+
+logger = logging.getLogger(__name__)
+
+# the model whose row each endpoint looks up by its id view argument
+LOOKUPS = {
+    "api.get_post": Post,
+    "api.edit_post": Post,
+    "api.get_post_comments": Post,
+    "api.new_post_comment": Post,
+    "api.get_user": User,
+    "api.get_user_posts": User,
+    "api.get_user_followed_posts": User,
+    "api.get_comment": Comment,
+}
+
+
+def _environ(sub_request):
+    """WSGI environ of a sub-request, on the host of the batch request"""
+    if not isinstance(sub_request, dict) or not isinstance(
+        sub_request.get("path"), str
+    ):
+        raise ValidationError("every request needs a path")
+    method = sub_request.get("method", "GET")
+    if not isinstance(method, str):
+        raise ValidationError("method must be a string")
+    headers = sub_request.get("headers") or {}
+    if not isinstance(headers, dict) or not all(
+        isinstance(value, str) for value in headers.values()
+    ):
+        raise ValidationError("headers must be an object of strings")
+    return EnvironBuilder(
+        path=sub_request["path"],
+        base_url=request.host_url,
+        method=method.upper(),
+        headers=headers,
+        json=sub_request.get("body"),
+    ).get_environ()
+
+
+def _dispatch(environ):
+    """Run one sub-request, returns its response
+
+    The batch request already went through the api before_request
+    handlers, so the sub-request reuses its g.current_user instead of
+    authenticating again.
+    """
+    app = current_app._get_current_object()
+    with app.request_context(environ):
+        if (
+            request.routing_exception is not None
+            or request.blueprint != "api"
+            or request.endpoint == "api.batch"
+        ):
+            return app.make_response((jsonify({"error": "not found"}), 404))
+        try:
+            try:
+                rv = app.dispatch_request()
+            except Exception as e:
+                rv = app.handle_user_exception(e)
+        except Exception:
+            # one failing sub-request must not fail those already run,
+            # whose work may be committed
+            logger.exception("batched request to %s failed", request.path)
+            db.session.rollback()
+            rv = jsonify({"error": "internal server error"}), 500
+        return app.make_response(rv)
+
+
+def _prefetch(environs):
+    """Load the rows the sub-requests look up by id with one IN query per
+    model; get_or_404() then finds them in the identity map"""
+    adapter = current_app.url_map.bind("")
+    ids = {}
+    for environ in environs:
+        try:
+            endpoint, args = adapter.match(
+                environ["PATH_INFO"], environ["REQUEST_METHOD"]
+            )
+        except HTTPException:
+            continue
+        if endpoint in LOOKUPS and "id" in args:
+            ids.setdefault(LOOKUPS[endpoint], set()).add(args["id"])
+    return [
+        row
+        for model, model_ids in ids.items()
+        for row in model.query.filter(model.id.in_(model_ids))
+    ]
+
+
+@api.route("/batch", methods=["POST"])
+def batch():
+    """Run a list of API requests in one round trip
+
+    The body is {"requests": [{"method": "GET", "path": "/api/v1/posts/1",
+    "headers": {...}, "body": {...}}, ...]}, method, headers and body
+    being optional. The response lists {"status", "headers", "body"} of
+    each, in order. Sub-requests run one after the other as the user of
+    the batch, at most IBLOG_API_MAX_BATCH_SIZE of them.
+    """
+    if not isinstance(request.json, dict):
+        raise ValidationError("the batch must be a JSON object")
+    sub_requests = request.json.get("requests")
+    if not isinstance(sub_requests, list):
+        raise ValidationError("requests must be a list")
+    if len(sub_requests) > current_app.config["IBLOG_API_MAX_BATCH_SIZE"]:
+        raise ValidationError("too many requests")
+    environs = [_environ(sub_request) for sub_request in sub_requests]
+    # kept referenced so the identity map holds on to them
+    prefetched = _prefetch(environs)  # noqa: F841
+    responses = []
+    for environ in environs:
+        response = _dispatch(environ)
+        responses.append(
+            {
+                "status": response.status_code,
+                "headers": {
+                    name: value
+                    for name, value in response.headers.items()
+                    if name not in ("Content-Type", "Content-Length")
+                },
+                "body": response.get_json() if response.is_json else None,
+            }
+        )
+    return jsonify({"responses": responses})
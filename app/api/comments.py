@@ -3,63 +3,73 @@ from .. import db
 from ..models import Post, Permission, Comment
 from . import api
 from .decorators import permission_required
+from .etags import conditional, make_etag
+from .fields import Representation
+from .pagination import paginate
 
 
 @api.route("/comments/")
 def get_comments():
-    page = request.args.get("page", 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page=page,
-        per_page=current_app.config["IBLOG_COMMENTS_PER_PAGE"],
-        error_out=False,
+    representation = Representation(Comment)
+    page = paginate(
+        representation.query(Comment.query),
+        Comment,
+        "api.get_comments",
+        current_app.config["IBLOG_COMMENTS_PER_PAGE"],
     )
-    comments = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for("api.get_comments", page=page - 1)
-    next = None
-    if pagination.has_next:
-        next = url_for("api.get_comments", page=page + 1)
-    return jsonify(
-        {
-            "comments": [comment.to_json() for comment in comments],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
+    representation.load(page.items)
+    etag = make_etag(*page.items, page.prev, page.next, page.total, representation)
+
+    def build():
+        json_comments = {
+            "comments": [representation.to_json(c) for c in page.items],
+            "prev": page.prev,
+            "next": page.next,
         }
-    )
+        if page.total is not None:
+            json_comments["count"] = page.total
+        return jsonify(json_comments)
+
+    return conditional(etag, build)
 
 
 @api.route("/comments/<int:id>")
 def get_comment(id):
-    comment = Comment.query.get_or_404(id)
-    return jsonify(comment.to_json())
+    representation = Representation(Comment)
+    comment = representation.query(Comment.query).get_or_404(id)
+    representation.load([comment])
+    return conditional(
+        make_etag(comment, representation),
+        lambda: jsonify(representation.to_json(comment)),
+    )
 
 
 @api.route("/posts/<int:id>/comments/")
 def get_post_comments(id):
+    representation = Representation(Comment)
     post = Post.query.get_or_404(id)
-    page = request.args.get("page", 1, type=int)
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page=page,
-        per_page=current_app.config["IBLOG_COMMENTS_PER_PAGE"],
-        error_out=False,
+    page = paginate(
+        representation.query(post.comments),
+        Comment,
+        "api.get_post_comments",
+        current_app.config["IBLOG_COMMENTS_PER_PAGE"],
+        ascending=True,
+        id=id,
     )
-    comments = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for("api.get_post_comments", id=id, page=page - 1)
-    next = None
-    if pagination.has_next:
-        next = url_for("api.get_post_comments", id=id, page=page + 1)
-    return jsonify(
-        {
-            "comments": [comment.to_json() for comment in comments],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
+    representation.load(page.items)
+    etag = make_etag(*page.items, page.prev, page.next, page.total, representation)
+
+    def build():
+        json_comments = {
+            "comments": [representation.to_json(c) for c in page.items],
+            "prev": page.prev,
+            "next": page.next,
         }
-    )
+        if page.total is not None:
+            json_comments["count"] = page.total
+        return jsonify(json_comments)
+
+    return conditional(etag, build)
 
 
 @api.route("/posts/<int:id>/comments/", methods=["POST"])
@@ -67,7 +77,7 @@ def get_post_comments(id):
 def new_post_comment(id):
     post = Post.query.get_or_404(id)
     comment = Comment.from_json(request.json)
-    comment.author = g.current_user
+    comment.author_id = g.current_user.id
     comment.post = post
     db.session.add(comment)
     db.session.commit()
@@ -0,0 +1,32 @@
+import hashlib
+
+from flask import current_app, request
+
+
+def make_etag(*parts):
+    """Strong ETag over the etag_parts() of the rows a response is built from
+
+    parts may be rows (anything with an etag_parts() method) or plain
+    values such as the page links, they are hashed by their repr.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        if hasattr(part, "etag_parts"):
+            part = part.etag_parts()
+        digest.update(repr(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def conditional(etag, build):
+    """Answer a GET with 304 when the client already holds etag
+
+    build() is only called, and the rows only serialized, when the client
+    copy is missing or stale.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,106 @@
+from flask import current_app, request
+
+from .. import db
+from ..exceptions import ValidationError
+from ..models import Comment, Post, User
+
+# the related objects ?expand= can inline into each kind of resource
+EXPANSIONS = {Post: {"author", "comments"}, Comment: {"author"}, User: set()}
+
+
+def _names(arg):
+    value = request.args.get(arg)
+    if value is None:
+        return None
+    return {name.strip() for name in value.split(",") if name.strip()}
+
+
+class Representation:
+    """The shape of the resources asked for with ?fields= and ?expand=
+
+    - ?fields=body,timestamp only computes the named fields of to_json()
+    - ?expand=author inlines the author of posts and comments, joined
+        into the query loading them
+    - ?expand=comments inlines the first page of comments of each post,
+        loaded for every post of the response with one query
+    - naming an expansion in ?fields= expands it, ?fields=body,author
+        is ?fields=body&expand=author
+    It is part of the ETag of the response, so every shape and the
+    expanded rows are validated separately.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = _names("fields")
+        self.expand = _names("expand") or set()
+        if self.fields is not None:
+            self.expand |= self.fields & EXPANSIONS[model]
+            self.fields -= EXPANSIONS[model]
+            unknown = self.fields - set(model.JSON_FIELDS)
+            if unknown:
+                raise ValidationError("unknown fields: " + ", ".join(sorted(unknown)))
+        unknown = self.expand - EXPANSIONS[model]
+        if unknown:
+            raise ValidationError("cannot expand: " + ", ".join(sorted(unknown)))
+        self.items = []
+        self.comments = {}
+
+    def query(self, query):
+        """query with the expanded authors joined in"""
+        if "author" in self.expand:
+            query = query.options(db.joinedload(self.model.author))
+        return query
+
+    def load(self, items):
+        """Load what the items expand to, returns the items"""
+        self.items = list(items)
+        if "comments" in self.expand and self.items:
+            self.comments = self._first_comments([item.id for item in self.items])
+        return self.items
+
+    @staticmethod
+    def _first_comments(post_ids):
+        # numbering the comments of each post caps them per post in SQL
+        position = (
+            db.func.row_number()
+            .over(
+                partition_by=Comment.post_id,
+                order_by=(Comment.timestamp.asc(), Comment.id.asc()),
+            )
+            .label("position")
+        )
+        numbered = (
+            db.select(Comment.id, position)
+            .where(Comment.post_id.in_(post_ids))
+            .subquery()
+        )
+        comments = (
+            Comment.query.join(numbered, numbered.c.id == Comment.id)
+            .filter(
+                numbered.c.position <= current_app.config["IBLOG_COMMENTS_PER_PAGE"]
+            )
+            .order_by(Comment.timestamp.asc(), Comment.id.asc())
+        )
+        by_post = {}
+        for comment in comments:
+            by_post.setdefault(comment.post_id, []).append(comment)
+        return by_post
+
+    def etag_parts(self):
+        parts = [sorted(self.fields or ()), sorted(self.expand)]
+        for item in self.items:
+            if "author" in self.expand:
+                parts.append(item.author.etag_parts())
+            for comment in self.comments.get(item.id, ()):
+                parts.append(comment.etag_parts())
+        return tuple(parts)
+
+    def to_json(self, item):
+        json_item = item.to_json(self.fields)
+        if "author" in self.expand:
+            json_item["author"] = item.author.to_json()
+        if "comments" in self.expand:
+            json_item["comments"] = [
+                comment.to_json() for comment in self.comments.get(item.id, ())
+            ]
+        return json_item
@@ -0,0 +1,106 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from flask import current_app, request, url_for
+
+from ..exceptions import ValidationError
+
+# total is None when the client didn't ask for a count
+Page = namedtuple("Page", ["items", "prev", "next", "total"])
+
+
+def encode_cursor(item):
+    """Opaque cursor pointing just past item in (timestamp, id) order"""
+    raw = json.dumps([item.timestamp.isoformat(), item.id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValidationError("invalid cursor")
+
+
+def paginate(query, model, endpoint, per_page, ascending=False, keys=None, **kwargs):
+    """Paginate a collection endpoint ordered by (timestamp, id)
+
+    - ?page=N keeps the original OFFSET based links and always counts
+    - ?cursor=<opaque>&limit=N seeks past the cursor using the
+        (timestamp, id) index, so deep pages cost the same as the first
+        one and no COUNT(*) is issued unless ?with_count=1 is given;
+        an empty cursor requests the first page
+    keys are the (timestamp, id) columns to order and seek by when they
+    are not those of model, e.g. those of the timeline index
+    kwargs are the url_for arguments of endpoint, e.g. the post id
+    """
+    timestamp_key, id_key = keys or (model.timestamp, model.id)
+    if ascending:
+        order = (timestamp_key.asc(), id_key.asc())
+    else:
+        order = (timestamp_key.desc(), id_key.desc())
+
+    if "cursor" not in request.args:
+        page = request.args.get("page", 1, type=int)
+        pagination = query.order_by(*order).paginate(
+            page=page, per_page=per_page, error_out=False
+        )
+        prev = None
+        if pagination.has_prev:
+            prev = url_for(endpoint, page=page - 1, **kwargs)
+        next = None
+        if pagination.has_next:
+            next = url_for(endpoint, page=page + 1, **kwargs)
+        return Page(pagination.items, prev, next, pagination.total)
+
+    limit = request.args.get("limit", per_page, type=int)
+    limit = max(1, min(limit, current_app.config["IBLOG_API_MAX_PAGE_SIZE"]))
+    with_count = request.args.get("with_count", 0, type=int) == 1
+
+    total = query.order_by(None).count() if with_count else None
+    cursor = request.args.get("cursor")
+    if cursor:
+        timestamp, id = decode_cursor(cursor)
+        if ascending:
+            query = query.filter(
+                (timestamp_key > timestamp)
+                | ((timestamp_key == timestamp) & (id_key > id))
+            )
+        else:
+            query = query.filter(
+                (timestamp_key < timestamp)
+                | ((timestamp_key == timestamp) & (id_key < id))
+            )
+    # one extra row tells us whether there is a next page without counting
+    items = query.order_by(*order).limit(limit + 1).all()
+    next = None
+    if len(items) > limit:
+        items = items[:limit]
+        extra = {"with_count": 1} if with_count else {}
+        next = url_for(
+            endpoint, cursor=encode_cursor(items[-1]), limit=limit, **extra, **kwargs
+        )
+    return Page(items, None, next, total)
+
+
+def by_ids(query, model):
+    """The rows of ?ids=1,2,3 in the order asked for, with one IN query
+
+    Ids of missing rows are skipped, at most IBLOG_API_MAX_PAGE_SIZE ids
+    can be asked for at once.
+    """
+    try:
+        ids = [int(id) for id in request.args["ids"].split(",") if id.strip()]
+    except ValueError:
+        raise ValidationError("ids must be comma separated integers")
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > current_app.config["IBLOG_API_MAX_PAGE_SIZE"]:
+        raise ValidationError("too many ids")
+    if not ids:
+        return []
+    rows = {row.id: row for row in query.filter(model.id.in_(ids))}
+    return [rows[id] for id in ids if id in rows]
@@ -5,42 +5,57 @@ from ..models import Post, Permission
 from .. import db
 from .errors import forbidden
 from .decorators import permission_required
+from .etags import conditional, make_etag
+from .fields import Representation
+from .pagination import by_ids, paginate
 
 
 @api.route("/posts/")
 def get_posts():
-    page = request.args.get("page", 1, type=int)
-    pagination = Post.query.paginate(
-        page=page, per_page=current_app.config["IBLOG_POSTS_PER_PAGE"], error_out=False
+    representation = Representation(Post)
+    query = representation.query(Post.query)
+    if "ids" in request.args:
+        posts = representation.load(by_ids(query, Post))
+        return conditional(
+            make_etag(*posts, representation),
+            lambda: jsonify({"posts": [representation.to_json(p) for p in posts]}),
+        )
+    page = paginate(
+        query, Post, "api.get_posts", current_app.config["IBLOG_POSTS_PER_PAGE"]
     )
-    posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for(".get_posts", page=page - 1)
-    next = None
-    if pagination.has_next:
-        next = url_for(".get_posts", page=page + 1)
-    return jsonify(
-        {
-            "posts": [post.to_json() for post in posts],
-            "prev_url": prev,
-            "next_url": next,
-            "count": pagination.total,
+    representation.load(page.items)
+    etag = make_etag(*page.items, page.prev, page.next, page.total, representation)
+
+    def build():
+        json_posts = {
+            "posts": [representation.to_json(post) for post in page.items],
+            "prev_url": page.prev,
+            "next_url": page.next,
         }
-    )
+        if page.total is not None:
+            json_posts["count"] = page.total
+        return jsonify(json_posts)
+
+    return conditional(etag, build)
 
 
 @api.route("/posts/<int:id>")
 def get_post(id):
-    post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    representation = Representation(Post)
+    post = representation.query(Post.query).get_or_404(id)
+    representation.load([post])
+    return conditional(
+        make_etag(post, representation),
+        lambda: jsonify(representation.to_json(post)),
+    )
 
 
 @api.route("/posts/", methods=["POST"])
 @permission_required(Permission.WRITE)
 def new_post():
     post = Post.from_json(request.json)
-    post.author = g.current_user
+    # g.current_user may be a TokenUser, which is not an ORM object
+    post.author_id = g.current_user.id
     db.session.add(post)
     db.session.commit()
     return (
@@ -0,0 +1,27 @@
+from flask import current_app, jsonify, request, url_for
+
+from . import api
+from .. import search
+
+
+@api.route("/search/")
+def search_posts_and_comments():
+    q = request.args.get("q", "").strip()
+    limit = request.args.get(
+        "limit", current_app.config["IBLOG_POSTS_PER_PAGE"], type=int
+    )
+    limit = max(1, min(limit, current_app.config["IBLOG_API_MAX_PAGE_SIZE"]))
+    hits, cursor = search.find(q, limit, request.args.get("cursor"))
+    ranks = {(hit.kind, hit.id): hit.rank for hit in hits}
+    next = None
+    if cursor:
+        next = url_for("api.search_posts_and_comments", q=q, limit=limit, cursor=cursor)
+    return jsonify(
+        {
+            "results": [
+                {"type": kind, "rank": ranks[kind, item.id], kind: item.to_json()}
+                for kind, item in search.load(hits)
+            ],
+            "next": next,
+        }
+    )
@@ -1,57 +1,87 @@
-from flask import jsonify, request, current_app, url_for
+from flask import jsonify, current_app, request
 from . import api
+from ..exceptions import ValidationError
 from ..models import User, Post
+from .etags import conditional, make_etag
+from .fields import Representation
+from .pagination import by_ids, paginate
+
+
+@api.route("/users/")
+def get_users():
+    # there is no listing of every user, only lookups of known ones
+    if "ids" not in request.args:
+        raise ValidationError("ids is required")
+    representation = Representation(User)
+    users = representation.load(by_ids(User.query, User))
+    return conditional(
+        make_etag(*users, representation),
+        lambda: jsonify({"users": [representation.to_json(u) for u in users]}),
+    )
 
 
 @api.route("/users/<int:id>")
 def get_user(id):
+    representation = Representation(User)
     user = User.query.get_or_404(id)
-    return jsonify(user.to_json())
+    representation.load([user])
+    return conditional(
+        make_etag(user, representation),
+        lambda: jsonify(representation.to_json(user)),
+    )
 
 
 @api.route("/users/<int:id>/posts/")
 def get_user_posts(id):
+    representation = Representation(Post)
     user = User.query.get_or_404(id)
-    page = request.args.get("page", 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config["IBLOG_POSTS_PER_PAGE"], error_out=False
+    page = paginate(
+        representation.query(user.posts),
+        Post,
+        "api.get_user_posts",
+        current_app.config["IBLOG_POSTS_PER_PAGE"],
+        id=id,
     )
-    posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for("api.get_user_posts", id=id, page=page - 1)
-    next = None
-    if pagination.has_next:
-        next = url_for("api.get_user_posts", id=id, page=page + 1)
-    return jsonify(
-        {
-            "posts": [post.to_json() for post in posts],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
+    representation.load(page.items)
+    etag = make_etag(*page.items, page.prev, page.next, page.total, representation)
+
+    def build():
+        json_posts = {
+            "posts": [representation.to_json(post) for post in page.items],
+            "prev": page.prev,
+            "next": page.next,
         }
-    )
+        if page.total is not None:
+            json_posts["count"] = page.total
+        return jsonify(json_posts)
+
+    return conditional(etag, build)
 
 
 @api.route("/users/<int:id>/timeline/")
 def get_user_followed_posts(id):
+    representation = Representation(Post)
     user = User.query.get_or_404(id)
-    page = request.args.get("page", 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config["IBLOG_POSTS_PER_PAGE"], error_out=False
+    query, keys = user.followed_timeline()
+    page = paginate(
+        representation.query(query),
+        Post,
+        "api.get_user_followed_posts",
+        current_app.config["IBLOG_POSTS_PER_PAGE"],
+        keys=keys,
+        id=id,
     )
-    posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for("api.get_user_followed_posts", id=id, page=page - 1)
-    next = None
-    if pagination.has_next:
-        next = url_for("api.get_user_followed_posts", id=id, page=page + 1)
-    return jsonify(
-        {
-            "posts": [post.to_json() for post in posts],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
+    representation.load(page.items)
+    etag = make_etag(*page.items, page.prev, page.next, page.total, representation)
+
+    def build():
+        json_posts = {
+            "posts": [representation.to_json(post) for post in page.items],
+            "prev": page.prev,
+            "next": page.next,
         }
-    )
+        if page.total is not None:
+            json_posts["count"] = page.total
+        return jsonify(json_posts)
+
+    return conditional(etag, build)
@@ -0,0 +1,260 @@
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from base64 import b64encode
+
+from . import create_app, db, fake, fragment_cache, last_seen_buffer, search
+from .models import Comment, Post, Role
+
+# rows generated for each dataset scale, see fake.bulk()
+SCALES = {
+    "small": dict(users=100, posts=1000, comments=2000, follows=1000),
+    "medium": dict(users=1000, posts=20000, comments=40000, follows=20000),
+    "large": dict(users=10000, posts=200000, comments=400000, follows=200000),
+}
+
+# part of the dataset file names, bumped when the schema changes so stale
+# datasets are regenerated instead of reused
+DATASET_VERSION = 4
+
+# endpoints requested with the fragment cache emptied first, against their
+# name without the suffix they show what the cached fragments save
+COLD_FRAGMENTS = ".cold_fragments"
+
+
+def endpoints(sample):
+    """(name, method, url, json body) of every benchmarked request"""
+    user, post, comment = sample["user"], sample["post"], sample["comment"]
+    body = {"body": "benchmark"}
+    return [
+        ("index", "GET", "/", None),
+        ("index" + COLD_FRAGMENTS, "GET", "/", None),
+        ("user", "GET", "/user/%s" % sample["username"], None),
+        ("post", "GET", "/posts/%d" % post, None),
+        ("post" + COLD_FRAGMENTS, "GET", "/posts/%d" % post, None),
+        ("followers", "GET", "/followers/%s" % sample["username"], None),
+        ("search", "GET", "/search?q=%s" % sample["word"], None),
+        ("api.get_posts", "GET", "/api/v1/posts/", None),
+        ("api.get_posts.cursor", "GET", "/api/v1/posts/?cursor=", None),
+        ("api.get_posts.ids", "GET", "/api/v1/posts/?ids=%d" % post, None),
+        ("api.get_post", "GET", "/api/v1/posts/%d" % post, None),
+        ("api.get_users", "GET", "/api/v1/users/?ids=%d" % user, None),
+        ("api.get_user", "GET", "/api/v1/users/%d" % user, None),
+        ("api.get_user_posts", "GET", "/api/v1/users/%d/posts/" % user, None),
+        (
+            "api.get_user_followed_posts",
+            "GET",
+            "/api/v1/users/%d/timeline/" % user,
+            None,
+        ),
+        ("api.get_comments", "GET", "/api/v1/comments/", None),
+        ("api.search", "GET", "/api/v1/search/?q=%s" % sample["word"], None),
+        ("api.get_comment", "GET", "/api/v1/comments/%d" % comment, None),
+        ("api.get_post_comments", "GET", "/api/v1/posts/%d/comments/" % post, None),
+        ("api.get_token", "POST", "/api/v1/tokens/", None),
+        ("api.new_post", "POST", "/api/v1/posts/", body),
+        ("api.edit_post", "PUT", "/api/v1/posts/%d" % post, body),
+        ("api.new_post_comment", "POST", "/api/v1/posts/%d/comments/" % post, body),
+        (
+            "api.batch",
+            "POST",
+            "/api/v1/batch",
+            {
+                "requests": [
+                    {"path": "/api/v1/posts/%d" % post},
+                    {"path": "/api/v1/users/%d" % user},
+                    {"path": "/api/v1/posts/%d/comments/" % post},
+                ]
+            },
+        ),
+    ]
+
+
+def dataset(app, scale, seed, directory):
+    """Path of the SQLite file holding the dataset of scale and seed,
+    generated on first use and reused by later runs"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "%s-%d-v%d.sqlite" % (scale, seed, DATASET_VERSION))
+    if not os.path.exists(path):
+        partial = path + ".partial"
+        if os.path.exists(partial):
+            os.remove(partial)
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + partial
+        with app.app_context():
+            db.create_all()
+            Role.insert_roles()
+            fake.bulk(seed=seed, **SCALES[scale])
+            db.session.remove()
+            db.engine.dispose()
+        os.rename(partial, path)
+    return path
+
+
+def _sample(app):
+    """The rows the requests are about: the most commented post, its
+    author and their first comment, so the pages are not trivial"""
+    with app.app_context():
+        post = Post.query.order_by(Post.comment_count.desc(), Post.id).first()
+        user = post.author
+        comment = post.comments.order_by(Comment.id).first()
+        return {
+            "user": user.id,
+            "username": user.username,
+            "email": user.email,
+            "post": post.id,
+            "comment": comment.id,
+            # the longest word of the post, something to search for
+            "word": max(search.terms(post.body), key=len),
+        }
+
+
+def _percentile(values, percent):
+    """Nearest rank percentile of the sorted values"""
+    return values[max(math.ceil(percent / 100 * len(values)), 1) - 1]
+
+
+def _git_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    config_name,
+    scale="small",
+    seed=0,
+    requests=50,
+    warmup=5,
+    directory=None,
+    progress=None,
+):
+    """Benchmark every endpoint on a fresh copy of a generated dataset
+
+    Each endpoint is requested warmup times, then requests times while
+    timing it and counting its queries, then a few more times under
+    tracemalloc, which would skew the timings. Web pages are requested
+    by the logged in sample user, the API with its email and password.
+    Returns the results as a dict, see compare() for reading two of them.
+    """
+    app = create_app(config_name)
+    app.config["WTF_CSRF_ENABLED"] = False
+    directory = directory or os.path.join(app.root_path, os.pardir, "tmp", "bench")
+    source = dataset(app, scale, seed, directory)
+
+    workdir = tempfile.mkdtemp()
+    try:
+        # requests write, every run starts from the pristine dataset
+        path = os.path.join(workdir, "bench.sqlite")
+        shutil.copyfile(source, path)
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+        sample = _sample(app)
+        results = {}
+        with app.app_context():
+            queries = []
+            db.event.listen(
+                db.engine,
+                "before_cursor_execute",
+                lambda *args: queries.append(1),
+            )
+            client = app.test_client(use_cookies=True)
+            client.post(
+                "/auth/login", data={"email": sample["email"], "password": "password"}
+            )
+            credentials = b64encode(
+                (sample["email"] + ":password").encode("utf-8")
+            ).decode("ascii")
+            headers = {"Authorization": "Basic " + credentials}
+
+            for name, method, url, body in endpoints(sample):
+
+                def request():
+                    if name.endswith(COLD_FRAGMENTS):
+                        fragment_cache.clear()
+                    response = client.open(
+                        url, method=method, json=body, headers=headers
+                    )
+                    if response.status_code >= 400:
+                        raise RuntimeError(
+                            "%s %s returned %d" % (method, url, response.status_code)
+                        )
+
+                for _ in range(warmup):
+                    request()
+                timings = []
+                del queries[:]
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    request()
+                    timings.append((time.perf_counter() - start) * 1000)
+                query_count = len(queries)
+                allocated = []
+                tracemalloc.start()
+                try:
+                    for _ in range(max(requests // 10, 1)):
+                        tracemalloc.reset_peak()
+                        before = tracemalloc.get_traced_memory()[0]
+                        request()
+                        allocated.append(tracemalloc.get_traced_memory()[1] - before)
+                finally:
+                    tracemalloc.stop()
+                timings.sort()
+                results[name] = {
+                    "method": method,
+                    "url": url,
+                    "p50_ms": _percentile(timings, 50),
+                    "p95_ms": _percentile(timings, 95),
+                    "p99_ms": _percentile(timings, 99),
+                    "mean_ms": sum(timings) / len(timings),
+                    "queries": query_count / requests,
+                    "peak_alloc_kib": max(allocated) / 1024,
+                }
+                if progress is not None:
+                    progress(name, results[name])
+            # not at exit, once the working copy is gone
+            last_seen_buffer.flush()
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "scale": scale,
+        "rows": SCALES[scale],
+        "seed": seed,
+        "sample": sample,
+        "requests": requests,
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "endpoints": results,
+    }
+
+
+def compare(old, new):
+    """Yield (endpoint, metric, old value, new value) for every metric of
+    the endpoints two results of run() have in common"""
+    for name, metrics in new["endpoints"].items():
+        previous = old["endpoints"].get(name)
+        if previous is None:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "queries", "peak_alloc_kib"):
+            yield name, metric, previous[metric], metrics[metric]
+
+
+def save(results, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+
+class LRUCache:
+    """Thread safe, size bounded least recently used cache
+
+    Entries optionally expire ttl seconds after they were set. The hit,
+    miss and eviction counters are exposed through info().
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class AppCache:
+    """Flask extension giving each application its own LRUCache
+
+    The cache is sized by the <config_prefix>_SIZE setting and its entries
+    expire after <config_prefix>_TTL seconds (never when it is missing
+    or 0). Outside of an application context every lookup misses and
+    nothing is stored.
+    """
+
+    def __init__(self, config_prefix):
+        self.config_prefix = config_prefix
+
+    def init_app(self, app):
+        app.extensions[self.config_prefix.lower()] = LRUCache(
+            app.config[self.config_prefix + "_SIZE"],
+            app.config.get(self.config_prefix + "_TTL"),
+        )
+
+    @property
+    def cache(self):
+        if not has_app_context():
+            return None
+        return current_app.extensions[self.config_prefix.lower()]
+
+    def get(self, key, default=None):
+        cache = self.cache
+        if cache is None:
+            return default
+        return cache.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        cache = self.cache
+        if cache is not None:
+            cache.set(key, value, ttl)
+
+    def delete(self, key):
+        cache = self.cache
+        if cache is not None:
+            cache.delete(key)
+
+    def clear(self):
+        cache = self.cache
+        if cache is not None:
+            cache.clear()
+
+    def info(self):
+        cache = self.cache
+        return cache.info() if cache is not None else {}
@@ -1,5 +1,5 @@
 from functools import wraps
-from flask import abort
+from flask import abort, current_app, g
 from flask_login import current_user
 from .models import Permission
 
@@ -19,3 +19,24 @@ def permission_required(permission):
 
 def admin_required(f):
     return permission_required(Permission.ADMIN)(f)
+
+
+def no_lazy_loads(f):
+    """Make the view fail with LazyLoadError if it, or the templates it
+    renders, lazy load a relationship of the rows it queried
+
+    Only active when IBLOG_RAISE_ON_LAZY_LOAD is set (it is under testing),
+    it catches list views that forgot to eager load what they display.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_app.config["IBLOG_RAISE_ON_LAZY_LOAD"]:
+            return f(*args, **kwargs)
+        g.forbid_lazy_loads = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.forbid_lazy_loads = False
+
+    return decorated_function
@@ -1,15 +1,6 @@
-from threading import Thread
-
 from flask import current_app, render_template
 from flask_mail import Message
-from . import mail
-
-
-def send_async_email(app, msg):
-    # needs the application context to be created artificially
-    # contexts are associated with a thread when mail.send() executes
-    with app.app_context():
-        mail.send(msg)
+from . import mail_queue
 
 
 def send_email(to, subject, template, **kwargs):
@@ -21,7 +12,5 @@ def send_email(to, subject, template, **kwargs):
     )
     msg.body = render_template(template + ".txt", **kwargs)
     msg.html = render_template(template + ".html", **kwargs)
-    # moving email sending function to a background thread
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    # sent in the background by the workers of the mail queue
+    return mail_queue.send(msg)
@@ -1,2 +1,6 @@
 class ValidationError(ValueError):
     pass
+
+
+class LazyLoadError(RuntimeError):
+    """A view guarded by no_lazy_loads lazy loaded a relationship"""
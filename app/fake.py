@@ -1,8 +1,14 @@
-from random import randint
+import hashlib
+from bisect import bisect
+from datetime import datetime, timedelta
+from itertools import accumulate
+from random import Random, randint
 from sqlalchemy.exc import IntegrityError
 from faker import Faker
-from . import db
-from .models import User, Post
+from werkzeug.security import generate_password_hash
+from . import db, search
+from .models import Comment, Follow, Post, PostScore, Role, TimelineEntry, User
+from .rendering import render_body
 
 
 def users(count=100):
@@ -36,3 +42,179 @@ def posts(count=100):
         p = Post(body=fake.text(), timestamp=fake.past_date(), author=u)
         db.session.add(p)
     db.session.commit()
+
+
+def _power_law(ids, rng, alpha=1.1):
+    """Picker giving the k-th id of a shuffled ids a weight of
+    1 / k ** alpha, so a few ids get most picks, like followers do"""
+    ids = list(ids)
+    rng.shuffle(ids)
+    cum_weights = list(accumulate(1 / k**alpha for k in range(1, len(ids) + 1)))
+    total = cum_weights[-1]
+
+    def pick():
+        return ids[bisect(cum_weights, rng.random() * total)]
+
+    return pick
+
+
+def _timestamp(rng, now, after=None):
+    """A time of the past year, later than after if given"""
+    start = now - timedelta(days=365) if after is None else after
+    span = max(int((now - start).total_seconds()), 1)
+    return start + timedelta(seconds=rng.randrange(span))
+
+
+def bulk(
+    users=0, posts=0, comments=0, follows=0, seed=0, batch_size=5000, progress=None
+):
+    """Generate rows in bulk for scale testing
+
+    Unlike users() and posts() every table is written with executemany
+    INSERTs of batch_size rows, picking authors, posts and follows from
+    id arrays fetched once. Post authors and followed users follow a
+    power law, the same seed generates the same content and graph.
+    Bodies are drawn from a pool of texts so Markdown is rendered once
+    per distinct body. The denormalized counters and the timelines are
+    rebuilt at the end. progress(table, rows) is called after each batch.
+    """
+    rng = Random(seed)
+    fake = Faker()
+    fake.seed_instance(seed)
+    now = datetime.utcnow()
+    # faker is slow, rows draw from pools of values generated once
+    pool = range(min(1000, max(users, posts, comments, 1)))
+    texts = [fake.text() for _ in pool]
+    user_names = [fake.user_name() for _ in pool]
+    names = [fake.name() for _ in pool]
+    cities = [fake.city() for _ in pool]
+    # hashing a password per user would dominate the run
+    password_hash = generate_password_hash("password")
+    role_id = Role.query.filter_by(default=True).first().id
+
+    def insert(table, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                db.session.execute(table.insert(), batch)
+                db.session.commit()
+                if progress is not None:
+                    progress(table.name, len(batch))
+                batch = []
+        if batch:
+            db.session.execute(table.insert(), batch)
+            db.session.commit()
+            if progress is not None:
+                progress(table.name, len(batch))
+
+    def ids(model):
+        return (
+            db.session.execute(db.select(model.id).order_by(model.id)).scalars().all()
+        )
+
+    first_user = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+    def new_users():
+        for n in range(first_user, first_user + users):
+            # the number keeps names and emails unique
+            username = "%s%d" % (rng.choice(user_names), n)
+            email = "%s@example.com" % username
+            member_since = _timestamp(rng, now)
+            yield {
+                "username": username,
+                "email": email,
+                "password_hash": password_hash,
+                "confirmed": True,
+                "role_id": role_id,
+                "name": rng.choice(names),
+                "location": rng.choice(cities),
+                "about_me": rng.choice(texts),
+                "member_since": member_since,
+                "last_seen": _timestamp(rng, now, member_since),
+                "avatar_hash": hashlib.md5(email.encode("utf-8")).hexdigest(),
+            }
+
+    insert(User.__table__, new_users())
+    user_ids = ids(User)
+    new_user_ids = [id for id in user_ids if id >= first_user]
+
+    def new_follows():
+        # every user follows themselves, see User.__init__
+        for id in new_user_ids:
+            yield {"follower_id": id, "followed_id": id, "timestamp": now}
+        if not follows or len(user_ids) < 2:
+            return
+        seen = set(
+            db.session.execute(db.select(Follow.follower_id, Follow.followed_id)).all()
+        )
+        seen.update((id, id) for id in new_user_ids)
+        popular = _power_law(user_ids, rng)
+        # a follow graph denser than complete is impossible
+        target = min(follows, len(user_ids) * (len(user_ids) - 1))
+        made = misses = 0
+        # near a complete graph most picks are duplicates, stop early there
+        while made < target and misses < 10 * target + 1000:
+            follower = rng.choice(user_ids)
+            followed = popular()
+            if (follower, followed) in seen:
+                misses += 1
+                continue
+            seen.add((follower, followed))
+            made += 1
+            yield {
+                "follower_id": follower,
+                "followed_id": followed,
+                "timestamp": _timestamp(rng, now),
+            }
+
+    insert(Follow.__table__, new_follows())
+
+    if posts and user_ids:
+        author = _power_law(user_ids, rng)
+        html = {}
+
+        def new_posts():
+            for _ in range(posts):
+                body = rng.choice(texts)
+                if body not in html:
+                    html[body] = render_body(body, "post")
+                yield {
+                    "body": body,
+                    "body_html": html[body],
+                    "timestamp": _timestamp(rng, now),
+                    "author_id": author(),
+                }
+
+        insert(Post.__table__, new_posts())
+
+    if comments and user_ids:
+        post_rows = db.session.execute(db.select(Post.id, Post.timestamp)).all()
+        html = {}
+
+        def new_comments():
+            if not post_rows:
+                return
+            for _ in range(comments):
+                body = rng.choice(texts)
+                if body not in html:
+                    html[body] = render_body(body, "comment")
+                post_id, posted = rng.choice(post_rows)
+                yield {
+                    "body": body,
+                    "body_html": html[body],
+                    "timestamp": _timestamp(rng, now, posted),
+                    "disabled": False,
+                    "author_id": rng.choice(user_ids),
+                    "post_id": post_id,
+                }
+
+        insert(Comment.__table__, new_comments())
+
+    # the inserts bypassed the model events keeping these in step
+    User.recount()
+    Post.recount()
+    TimelineEntry.rebuild()
+    PostScore.compact()
+    search.rebuild()
+    db.session.commit()
@@ -0,0 +1,58 @@
+from flask import render_template
+from flask_login import current_user
+from markupsafe import Markup
+
+from . import fragment_cache
+
+
+def viewer_class(post):
+    """Which variant of the post footer current_user gets"""
+    if current_user.is_authenticated and current_user.id == post.author_id:
+        return "owner"
+    if current_user.is_administrator():
+        return "admin"
+    return "other"
+
+
+def _cached(key, template, **context):
+    html = fragment_cache.get(key)
+    if html is None:
+        html = Markup(render_template(template, **context))
+        fragment_cache.set(key, html)
+    return html
+
+
+def render_post(post):
+    """The <li> of a post in _posts.html, rendered once per version
+
+    The key holds everything the markup depends on: the post's version
+    (bumped by every edit), its rendered body, in case it was rewritten
+    without a version bump, its comment counter, the name and avatar of
+    its author and the viewer class, as owners and admins get Edit links.
+    """
+    key = (
+        "post",
+        post.id,
+        post.version,
+        hash(post.body_html),
+        post.comment_count,
+        post.author.username,
+        post.author.avatar_hash,
+        viewer_class(post),
+    )
+    return _cached(key, "_post.html", post=post)
+
+
+def render_comment(comment, moderate=False, page=None):
+    """The <li> of a comment in _comments.html, rendered once per version"""
+    key = (
+        "comment",
+        comment.id,
+        comment.version,
+        hash(comment.body_html),
+        comment.author.username,
+        comment.author.avatar_hash,
+        # the moderation buttons link back to the page they are on
+        (moderate, page) if moderate else False,
+    )
+    return _cached(key, "_comment.html", comment=comment, moderate=moderate, page=page)
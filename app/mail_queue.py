@@ -0,0 +1,166 @@
+import atexit
+import logging
+import queue
+import smtplib
+import threading
+import time
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+def _retryable(error):
+    """Whether error lost the connection rather than being the answer of
+    the server, a new session may then succeed"""
+    # SMTPException is an OSError too
+    return isinstance(
+        error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+    ) or not isinstance(error, smtplib.SMTPException)
+
+
+class MailQueue:
+    """Bounded queue of outgoing messages served by a fixed pool of workers
+
+    Each worker takes whatever is queued, up to IBLOG_MAIL_BATCH_SIZE
+    messages, and sends it over a single SMTP session. A failed session is
+    retried IBLOG_MAIL_RETRIES times with exponential backoff starting at
+    IBLOG_MAIL_RETRY_BACKOFF seconds, resuming with the first unsent message;
+    a message the server rejects is dropped without failing the others.
+    When the IBLOG_MAIL_QUEUE_SIZE slots are taken send() blocks for up to
+    IBLOG_MAIL_QUEUE_TIMEOUT seconds and then drops the message.
+    The workers are started by the first message and drained when the
+    process exits. With IBLOG_MAIL_WORKERS set to 0 messages are sent
+    right away by the caller.
+    """
+
+    def init_app(self, app):
+        app.extensions["mail_queue"] = {
+            "queue": queue.Queue(app.config["IBLOG_MAIL_QUEUE_SIZE"]),
+            "lock": threading.Lock(),
+            "workers": [],
+            "stopping": threading.Event(),
+            "stats": {"sent": 0, "failed": 0, "retries": 0, "dropped": 0},
+        }
+        atexit.register(self._drain_at_exit, app)
+
+    def _state(self, app=None):
+        return (app or current_app).extensions["mail_queue"]
+
+    def send(self, msg):
+        """Queue msg, returns False if it had to be dropped"""
+        app = current_app._get_current_object()
+        state = self._state(app)
+        if app.config["IBLOG_MAIL_WORKERS"] == 0:
+            self._deliver(app, state, [msg])
+            return True
+        self._start_workers(app, state)
+        try:
+            state["queue"].put(msg, timeout=app.config["IBLOG_MAIL_QUEUE_TIMEOUT"])
+        except queue.Full:
+            with state["lock"]:
+                state["stats"]["dropped"] += 1
+            logger.error("mail queue full, dropped message to %s", msg.recipients)
+            return False
+        return True
+
+    def _start_workers(self, app, state):
+        with state["lock"]:
+            state["workers"] = [w for w in state["workers"] if w.is_alive()]
+            while len(state["workers"]) < app.config["IBLOG_MAIL_WORKERS"]:
+                worker = threading.Thread(
+                    target=self._work, args=(app, state), daemon=True
+                )
+                worker.start()
+                state["workers"].append(worker)
+
+    def _work(self, app, state):
+        batch_size = app.config["IBLOG_MAIL_BATCH_SIZE"]
+        messages = state["queue"]
+        while True:
+            try:
+                batch = [messages.get(timeout=0.1)]
+            except queue.Empty:
+                if state["stopping"].is_set():
+                    return
+                continue
+            while len(batch) < batch_size:
+                try:
+                    batch.append(messages.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._deliver(app, state, batch)
+            except Exception:
+                # never let a bug take a worker down with the queue full
+                logger.exception("mail worker failed")
+            finally:
+                for _ in batch:
+                    messages.task_done()
+
+    def _deliver(self, app, state, batch):
+        from . import mail
+
+        stats = state["stats"]
+        pending = list(batch)
+        attempt = 0
+        with app.app_context():
+            while pending:
+                try:
+                    with mail.connect() as connection:
+                        while pending:
+                            try:
+                                connection.send(pending[0])
+                            except smtplib.SMTPException as e:
+                                if _retryable(e):
+                                    raise
+                                # rejected by the server, retrying would not help
+                                logger.exception("could not send %s", pending[0])
+                                with state["lock"]:
+                                    stats["failed"] += 1
+                            else:
+                                with state["lock"]:
+                                    stats["sent"] += 1
+                            pending.pop(0)
+                except OSError as e:
+                    attempt += 1
+                    if not _retryable(e) or attempt > app.config["IBLOG_MAIL_RETRIES"]:
+                        logger.exception("giving up on %d messages", len(pending))
+                        with state["lock"]:
+                            stats["failed"] += len(pending)
+                        return
+                    with state["lock"]:
+                        stats["retries"] += 1
+                    time.sleep(
+                        app.config["IBLOG_MAIL_RETRY_BACKOFF"] * 2 ** (attempt - 1)
+                    )
+
+    def info(self):
+        """Queue depth and delivery counters of this worker process"""
+        state = self._state()
+        with state["lock"]:
+            info = dict(state["stats"])
+            info["workers"] = sum(w.is_alive() for w in state["workers"])
+        info["depth"] = state["queue"].qsize()
+        info["maxsize"] = state["queue"].maxsize
+        return info
+
+    def drain(self, timeout=None):
+        """Stop the workers once everything queued is sent, returns the
+        number of messages still queued when timeout ran out"""
+        state = self._state()
+        state["stopping"].set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in list(state["workers"]):
+            worker.join(
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+        state["workers"] = [w for w in state["workers"] if w.is_alive()]
+        state["stopping"].clear()
+        return state["queue"].qsize()
+
+    def _drain_at_exit(self, app):
+        with app.app_context():
+            left = self.drain(app.config["IBLOG_MAIL_DRAIN_TIMEOUT"])
+            if left:
+                logger.error("%d queued messages were not sent", left)
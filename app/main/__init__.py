@@ -1,4 +1,5 @@
 from flask import Blueprint
+from ..fragments import render_comment, render_post
 from ..models import Permission
 
 main = Blueprint("main", __name__)
@@ -17,4 +18,10 @@ def inject_permissions():
     return dict(Permission=Permission)
 
 
+@main.app_context_processor
+def inject_fragments():
+    # _posts.html and _comments.html stitch together cached fragments
+    return dict(render_post=render_post, render_comment=render_comment)
+
+
 from . import views, errors  # noqa
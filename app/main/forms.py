@@ -4,9 +4,12 @@ from wtforms import (
     TextAreaField,
     BooleanField,
     SelectField,
+    IntegerField,
 )
 from wtforms.validators import (
     DataRequired,
+    NumberRange,
+    Optional,
     Length,
     Email,
     Regexp,
@@ -95,3 +98,18 @@ class PostForm(FlaskForm):
 class CommentForm(FlaskForm):
     body = StringField("", validators=[DataRequired()])
     submit = SubmitField("Submit")
+
+
+class ResetForm(FlaskForm):
+    submit = SubmitField("Reset")
+
+
+class ProfilerForm(FlaskForm):
+    requests = IntegerField(
+        "Requests to profile", default=10, validators=[NumberRange(min=0)]
+    )
+    endpoint = StringField(
+        "Only requests of endpoint (e.g. main.index)",
+        validators=[Optional(), Length(1, 128)],
+    )
+    submit = SubmitField("Arm")
@@ -10,13 +10,23 @@ from flask import (
     request,
     abort,
     make_response,
+    jsonify,
 )
 from flask_login import login_required, current_user
-from .forms import EditProfileForm, EditProfileAdminForm, PostForm, CommentForm
-from .. import db
-from ..models import User, Role, Permission, Post, Comment
+from .forms import (
+    EditProfileForm,
+    EditProfileAdminForm,
+    PostForm,
+    CommentForm,
+    ResetForm,
+    ProfilerForm,
+)
+from .. import db, page_cache, query_stats, sampling_profiler, search
+from ..models import User, Role, Permission, Post, PostScore, Comment
 from . import main
-from ..decorators import admin_required, permission_required
+from ..decorators import admin_required, permission_required, no_lazy_loads
+from ..exceptions import ValidationError
+from ..query_stats import fingerprint
 from flask_sqlalchemy import get_debug_queries
 
 
@@ -25,12 +35,19 @@ def after_request(response):
     for query in get_debug_queries():
         if query.duration >= current_app.config["IBLOG_SLOW_DB_QUERY_TIME"]:
             current_app.logger.warning(
-                "Slow query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n"
-                % (query.statement, query.parameters, query.duration, query.context)
+                "Slow query: %s\nDuration: %fs\nEndpoint: %s\n"
+                % (fingerprint(query.statement), query.duration, request.endpoint)
             )
     return response
 
 
+def tag_page(posts=(), comments=()):
+    """Tag the cached page with the posts and comments it shows"""
+    page_cache.tag(*("post:%s" % post.id for post in posts))
+    page_cache.tag(*("user:%s" % post.author_id for post in posts))
+    page_cache.tag(*("user:%s" % comment.author_id for comment in comments))
+
+
 @main.route("/shutdown")
 def server_shutdown():
     """
@@ -56,6 +73,8 @@ def server_shutdown():
 
 
 @main.route("/", methods=["GET", "POST"])
+@page_cache.cached
+@no_lazy_loads
 def index():
     form = PostForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
@@ -64,25 +83,34 @@ def index():
         db.session.commit()
         return redirect(url_for(".index"))
     page = request.args.get("page", 1, type=int)
-    show_followed = False
+    show_followed = show_trending = False
     if current_user.is_authenticated:
         show_followed = bool(request.cookies.get("show_followed", ""))
-    if show_followed:
+        show_trending = bool(request.cookies.get("show_trending", ""))
+    if show_trending:
+        # read off the post_scores index, no aggregation per request
+        show_followed = False
+        query = PostScore.trending_posts()
+    elif show_followed:
         query = current_user.followed_posts
     else:
-        query = Post.query
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
+        query = Post.query.order_by(Post.timestamp.desc())
+    query = Post.with_author(query)
+    pagination = query.paginate(
         page=page,
         per_page=int(current_app.config["IBLOG_POSTS_PER_PAGE"]),
         error_out=False,
     )
     # posts = Post.query.order_by(Post.timestamp.desc()).all()
     posts = pagination.items
+    page_cache.tag("posts")
+    tag_page(posts)
     return render_template(
         "index.html",
         form=form,
         posts=posts,
         show_followed=show_followed,
+        show_trending=show_trending,
         pagination=pagination,
     )
 
@@ -92,6 +120,7 @@ def index():
 def show_all():
     resp = make_response(redirect(url_for(".index")))
     resp.set_cookie("show_followed", "", max_age=30 * 24 * 60 * 60)  # 30 days
+    resp.set_cookie("show_trending", "", max_age=30 * 24 * 60 * 60)
     return resp
 
 
@@ -102,20 +131,34 @@ def show_followed():
     # not setting max_age will result in cookie expiration when browser
     # is closed
     resp.set_cookie("show_followed", "1", max_age=30 * 24 * 60 * 60)  # 30 days
+    resp.set_cookie("show_trending", "", max_age=30 * 24 * 60 * 60)
+    return resp
+
+
+@main.route("/trending")
+@login_required
+def show_trending():
+    resp = make_response(redirect(url_for(".index")))
+    resp.set_cookie("show_trending", "1", max_age=30 * 24 * 60 * 60)  # 30 days
     return resp
 
 
 @main.route("/user/<username>")
+@page_cache.cached
+@no_lazy_loads
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     # posts = user.posts.order_by(Post.timestamp.desc()).all()
     page = request.args.get("page", 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
+    query = Post.with_author(user.posts)
+    pagination = query.order_by(Post.timestamp.desc()).paginate(
         page=page,
         per_page=int(current_app.config["IBLOG_POSTS_PER_PAGE"]),
         error_out=False,
     )
     posts = pagination.items
+    page_cache.tag("user:%s" % user.id)
+    tag_page(posts)
     return render_template("user.html", user=user, posts=posts)
 
 
@@ -173,8 +216,10 @@ def edit_profile_admin(id):
 
 
 @main.route("/posts/<int:id>", methods=["GET", "POST"])
+@page_cache.cached
+@no_lazy_loads
 def post(id):
-    post = Post.query.get_or_404(id)
+    post = Post.with_author(Post.query).get_or_404(id)
     form = CommentForm()
     if form.validate_on_submit():
         # can't directly use current_user as it is a context variable proxy
@@ -190,20 +235,40 @@ def post(id):
     if page == -1:
         # a special page no. used to request the last page of comments
         # so that the comment just entered is seen on the page.
-        page = (post.comments.count() - 1) // current_app.config[
+        page = (post.comment_count - 1) // current_app.config[
             "IBLOG_COMMENTS_PER_PAGE"
         ] + 1
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
+    query = Comment.with_author(post.comments)
+    pagination = query.order_by(Comment.timestamp.asc()).paginate(
         page=page,
         per_page=current_app.config["IBLOG_COMMENTS_PER_PAGE"],
         error_out=False,
     )
     comments = pagination.items
+    tag_page([post], comments)
     return render_template(
         "post.html", posts=[post], form=form, comments=comments, pagination=pagination
     )
 
 
+@main.route("/search")
+@no_lazy_loads
+def search_page():
+    q = request.args.get("q", "").strip()
+    try:
+        hits, cursor = search.find(
+            q,
+            current_app.config["IBLOG_POSTS_PER_PAGE"],
+            request.args.get("cursor"),
+        )
+    except ValidationError:
+        abort(400)
+    next_url = url_for(".search_page", q=q, cursor=cursor) if cursor else None
+    return render_template(
+        "search.html", q=q, results=search.load(hits), next_url=next_url
+    )
+
+
 @main.route("/edit/<int:id>", methods=["GET", "POST"])
 def edit(id):
     post = Post.query.get_or_404(id)
@@ -306,12 +371,51 @@ def followed_by(username):
     )
 
 
+@main.route("/admin/query-stats", methods=["GET", "POST"])
+@login_required
+@admin_required
+def query_stats_page():
+    form = ResetForm()
+    if form.validate_on_submit():
+        query_stats.reset()
+        flash("The query statistics have been reset.")
+        return redirect(url_for(".query_stats_page"))
+    queries, untracked = query_stats.report()
+    return render_template(
+        "query_stats.html", queries=queries, untracked=untracked, form=form
+    )
+
+
+@main.route("/admin/query-stats.json")
+@login_required
+@admin_required
+def query_stats_json():
+    queries, untracked = query_stats.report()
+    return jsonify({"queries": queries, "untracked": untracked})
+
+
+@main.route("/admin/profiler", methods=["GET", "POST"])
+@login_required
+@admin_required
+def profiler():
+    form = ProfilerForm()
+    if form.validate_on_submit():
+        sampling_profiler.arm(form.requests.data, form.endpoint.data)
+        flash("The profiler has been armed.")
+        return redirect(url_for(".profiler"))
+    return render_template(
+        "profiler.html", form=form, status=sampling_profiler.status()
+    )
+
+
 @main.route("/moderate")
 @login_required
 @permission_required(Permission.MODERATE)
+@no_lazy_loads
 def moderate():
     page = request.args.get("page", 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
+    query = Comment.with_author(Comment.query)
+    pagination = query.order_by(Comment.timestamp.desc()).paginate(
         page=page,
         per_page=current_app.config["IBLOG_COMMENTS_PER_PAGE"],
         error_out=False,
@@ -1,14 +1,36 @@
 import hashlib
-import bleach
-
-from markdown import markdown
-from . import db, login_manager
-from flask import current_app, url_for  # , request
-from app.exceptions import ValidationError
-from flask_login import UserMixin, AnonymousUserMixin
+import math
+
+from . import (
+    db,
+    login_manager,
+    last_seen_buffer,
+    request_timing,
+    user_cache,
+    token_generation_cache,
+)
+from flask import current_app, g, has_app_context, url_for  # , request
+from app.exceptions import LazyLoadError, ValidationError
+from app.page_cache import invalidate_on_commit
+from app.rendering import render_body
+from app.search import index_document, remove_document
+from flask_login import UserMixin, AnonymousUserMixin, current_user
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import URLSafeTimedSerializer as Serializer
-from datetime import datetime
+from datetime import datetime, timedelta
+
+
+def json_fields(row, fields=None):
+    """The JSON_FIELDS of row, or those named in fields; the others are
+    not computed at all"""
+    return {
+        name: get(row)
+        for name, get in row.JSON_FIELDS.items()
+        if fields is None or name in fields
+    }
 
 
 class Permission:
@@ -78,8 +100,11 @@ class Role(db.Model):
             ],
         }
         default_role = "User"
+        # one query for the existing roles, only the roles whose
+        # permissions or default flag changed are written back
+        existing = {role.name: role for role in Role.query.filter(Role.name.in_(roles))}
         for r in roles:
-            role = Role.query.filter_by(name=r).first()
+            role = existing.get(r)
             if role is None:
                 role = Role(name=r)
             role.reset_permission()
@@ -94,7 +119,10 @@ class Follow(db.Model):
     __tablename__ = "follows"
     # many to one using foreignkey
     follower_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
-    followed_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    # the primary key index only covers lookups by follower
+    followed_id = db.Column(
+        db.Integer, db.ForeignKey("users.id"), primary_key=True, index=True
+    )
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
 
@@ -119,6 +147,15 @@ class User(UserMixin, db.Model):
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
     # caching the md5 hash to avoid frequent cpu intensive operation
     avatar_hash = db.Column(db.String(32))
+    # denormalized counters, kept in step by the model events at the
+    # bottom of this module (and rebuilt in bulk by `flask recount`)
+    post_count = db.Column(db.Integer, default=0, server_default="0")
+    follower_count = db.Column(db.Integer, default=0, server_default="0")
+    followed_count = db.Column(db.Integer, default=0, server_default="0")
+    # bumped by every ORM update, see on_row_updating
+    version = db.Column(db.Integer, default=1, server_default="1")
+    # bumped to revoke every stateless API token issued so far
+    token_generation = db.Column(db.Integer, default=0, server_default="0")
     # one to many relationship User 1-n Post
     posts = db.relationship("Post", backref="author", lazy="dynamic")
     comments = db.relationship("Comment", backref="author", lazy="dynamic")
@@ -172,13 +209,51 @@ class User(UserMixin, db.Model):
         self.password_hash = generate_password_hash(password=password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        with request_timing.measure("auth"):
+            return check_password_hash(self.password_hash, password)
+
+    def followed_timeline(self):
+        """Posts of the users this user follows, unordered, and the
+        (timestamp, id) columns to order and seek them by
+
+        Most of them were copied into the user's timeline_entries when they
+        were written. Then the posts are read in the order of the
+        (user_id, timestamp, post_id) index of the timeline, a range scan
+        that stops at the end of the page. The posts of authors with too
+        many followers to fan out are merged in at read time instead, for
+        the users following one of them.
+        """
+        merged = (
+            db.session.execute(
+                db.select(Follow.followed_id)
+                .join(User, User.id == Follow.followed_id)
+                .where(
+                    Follow.follower_id == self.id,
+                    User.follower_count
+                    > current_app.config["IBLOG_TIMELINE_FANOUT_LIMIT"],
+                )
+            )
+            .scalars()
+            .all()
+        )
+        if not merged:
+            query = Post.query.join(
+                TimelineEntry, TimelineEntry.post_id == Post.id
+            ).filter(TimelineEntry.user_id == self.id)
+            return query, (TimelineEntry.timestamp, TimelineEntry.post_id)
+        fanned_out = db.select(TimelineEntry.post_id).where(
+            TimelineEntry.user_id == self.id
+        )
+        query = Post.query.filter(
+            db.or_(Post.id.in_(fanned_out), Post.author_id.in_(merged))
+        )
+        return query, (Post.timestamp, Post.id)
 
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id).filter(
-            Follow.follower_id == self.id
-        )
+        """Posts of the users this user follows, newest first"""
+        query, (timestamp, id) = self.followed_timeline()
+        return query.order_by(timestamp.desc(), id.desc())
 
     def generate_confirmation_token(self):
         s = Serializer(current_app.config["SECRET_KEY"])
@@ -224,9 +299,65 @@ class User(UserMixin, db.Model):
         return self.can(Permission.ADMIN)
 
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
-        db.session.commit()
+        """Record that the user has just been seen
+
+        The write is buffered by last_seen_buffer and skipped entirely
+        while the stored time is less than IBLOG_LAST_SEEN_RESOLUTION
+        seconds old, so most page views don't write at all
+        """
+        now = datetime.utcnow()
+        resolution = current_app.config["IBLOG_LAST_SEEN_RESOLUTION"]
+        if (
+            self.last_seen is not None
+            and (now - self.last_seen).total_seconds() < resolution
+        ):
+            return
+        # update the loaded object without making it dirty, the buffer
+        # does the actual write
+        set_committed_value(self, "last_seen", now)
+        last_seen_buffer.record(self.id, now)
+        snapshot = user_cache.get(self.id)
+        if snapshot is not None:
+            snapshot["last_seen"] = now
+
+    # columns of the logged in user needed by most requests
+    SNAPSHOT_COLUMNS = ("id", "username", "confirmed", "avatar_hash", "last_seen")
+
+    def snapshot(self):
+        """Plain dict with the user columns and role permissions that
+        requests need, suitable for caching between requests"""
+        snapshot = {column: getattr(self, column) for column in self.SNAPSHOT_COLUMNS}
+        role = self.role
+        if role is not None:
+            snapshot["role"] = {
+                "id": role.id,
+                "name": role.name,
+                "default": role.default,
+                "permissions": role.permissions,
+            }
+        return snapshot
+
+    @staticmethod
+    def from_snapshot(snapshot):
+        """Attach a user built from a snapshot to the session without
+        querying the database
+
+        The columns left out of the snapshot are loaded on first access.
+        """
+        user = db.session.identity_map.get(identity_key(User, snapshot["id"]))
+        if user is not None:
+            return user
+        role = None
+        if "role" in snapshot:
+            role = db.session.identity_map.get(
+                identity_key(Role, snapshot["role"]["id"])
+            )
+            if role is None:
+                role = _detached_instance(Role, snapshot["role"])
+        values = {column: snapshot[column] for column in User.SNAPSHOT_COLUMNS}
+        values["role_id"] = role.id if role is not None else None
+        values["role"] = role
+        return _detached_instance(User, values)
 
     def generate_email_change_token(self, new_email):
         s = Serializer(current_app.config["SECRET_KEY"])
@@ -286,103 +417,214 @@ class User(UserMixin, db.Model):
         if f:
             db.session.delete(f)
 
+    @staticmethod
+    def recount():
+        """Rebuild the stored post and follow counters of every user with
+        one UPDATE instead of a COUNT query per user"""
+        users = User.__table__
+        posts = Post.__table__
+        follows = Follow.__table__
+
+        def count(column):
+            return (
+                db.select(db.func.count()).where(column == users.c.id).scalar_subquery()
+            )
+
+        db.session.execute(
+            users.update().values(
+                post_count=count(posts.c.author_id),
+                follower_count=count(follows.c.followed_id),
+                followed_count=count(follows.c.follower_id),
+            )
+        )
+
     @staticmethod
     def add_self_follows():
-        for user in User.query.all():
-            if not user.is_following(user):
-                user.follow(user)
-                db.session.add(user)
-                db.session.commit()
+        """Make every user follow themselves, as User() does for new users
+
+        Runs a fixed number of statements whatever the number of users:
+        the follow counters and timelines of the users missing their self
+        follow are fixed up in bulk, as the model events that would do it
+        don't run for INSERT ... SELECT, then the follows are inserted.
+        """
+        users = User.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        entries = TimelineEntry.__table__
+        missing = ~db.exists().where(
+            follows.c.follower_id == users.c.id, follows.c.followed_id == users.c.id
+        )
+        db.session.execute(
+            users.update()
+            .where(missing)
+            .values(
+                follower_count=users.c.follower_count + 1,
+                followed_count=users.c.followed_count + 1,
+            )
+        )
+        already = db.exists().where(
+            entries.c.user_id == posts.c.author_id, entries.c.post_id == posts.c.id
+        )
+        db.session.execute(
+            entries.insert().from_select(
+                ["user_id", "post_id", "author_id", "timestamp"],
+                db.select(
+                    posts.c.author_id, posts.c.id, posts.c.author_id, posts.c.timestamp
+                )
+                .join(users, users.c.id == posts.c.author_id)
+                .where(
+                    missing,
+                    ~already,
+                    users.c.follower_count
+                    <= current_app.config["IBLOG_TIMELINE_FANOUT_LIMIT"],
+                ),
+            )
+        )
+        db.session.execute(
+            follows.insert().from_select(
+                ["follower_id", "followed_id", "timestamp"],
+                db.select(users.c.id, users.c.id, db.literal(datetime.utcnow())).where(
+                    missing
+                ),
+            )
+        )
+        db.session.commit()
 
     def generate_auth_token(self):
         s = Serializer(current_app.config["SECRET_KEY"])
-        return s.dumps({"id": self.id})
+        if not current_app.config["IBLOG_STATELESS_TOKENS"]:
+            return s.dumps({"id": self.id})
+        # self-describing token, lets requests be authorized without
+        # loading the user, see verify_auth_token
+        return s.dumps(
+            {
+                "id": self.id,
+                "confirmed": self.confirmed,
+                "permissions": self.role.permissions if self.role else 0,
+                "generation": self.token_generation or 0,
+            }
+        )
+
+    def revoke_auth_tokens(self):
+        """Invalidate every stateless token issued to this user so far"""
+        self.token_generation = (self.token_generation or 0) + 1
+        db.session.add(self)
+
+    @staticmethod
+    def current_token_generation(id):
+        """token_generation of user id, cached for a few seconds per worker
+        Returns None when the user doesn't exist"""
+        generation = token_generation_cache.get(id)
+        if generation is None:
+            generation = (
+                db.session.query(User.token_generation).filter_by(id=id).scalar()
+            )
+            if generation is not None:
+                token_generation_cache.set(id, generation)
+        return generation
 
     @staticmethod
     def verify_auth_token(token, expiration=3600):
         s = Serializer(current_app.config["SECRET_KEY"])
         try:
-            data = s.loads(token, max_age=expiration)
+            with request_timing.measure("auth"):
+                data = s.loads(token, max_age=expiration)
         except:  # noqa
             return None
-        return User.query.get(data["id"])
-
-    def to_json(self):
-        json_user = {
-            "url": url_for("api.get_user", id=self.id),
-            "username": self.username,
-            "member_since": self.member_since,
-            "last_seen": self.last_seen,
-            "posts_url": url_for("api.get_user_posts", id=self.id),
-            "followed_posts_url": url_for("api.get_user_followed_posts", id=self.id),
-            "post_count": self.posts.count(),
-        }
-        return json_user
+        if "generation" not in data:
+            return User.query.get(data["id"])
+        if User.current_token_generation(data["id"]) != data["generation"]:
+            return None
+        return TokenUser(data)
+
+    def etag_parts(self):
+        """Values that change whenever to_json() does"""
+        # last_seen and post_count are written outside of the ORM
+        return ("user", self.id, self.version, self.last_seen, self.post_count)
+
+    # how each field of to_json() is computed
+    JSON_FIELDS = {
+        "url": lambda user: url_for("api.get_user", id=user.id),
+        "username": lambda user: user.username,
+        "member_since": lambda user: user.member_since,
+        "last_seen": lambda user: user.last_seen,
+        "posts_url": lambda user: url_for("api.get_user_posts", id=user.id),
+        "followed_posts_url": lambda user: url_for(
+            "api.get_user_followed_posts", id=user.id
+        ),
+        "post_count": lambda user: user.post_count,
+    }
+
+    def to_json(self, fields=None):
+        """JSON representation, with only the names in fields if given"""
+        return json_fields(self, fields)
 
 
 class Post(db.Model):
     __tablename__ = "posts"
+    # backs the (timestamp, id) ordering used by keyset pagination
+    __table_args__ = (db.Index("ix_posts_timestamp_id", "timestamp", "id"),)
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    author_id = db.Column(db.Integer, db.ForeignKey(User.id))
+    author_id = db.Column(db.Integer, db.ForeignKey(User.id), index=True)
     # keeps the converted text, Markdown to HTML
     body_html = db.Column(db.Text)
+    comment_count = db.Column(db.Integer, default=0, server_default="0")
+    version = db.Column(db.Integer, default=1, server_default="1")
     comments = db.relationship("Comment", backref="post", lazy="dynamic")
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
         """
         Handles the conversion of Markdown text to HTML
-        Steps:
-        1) markdown() func does initial conversion to HTML
-        2) result passed to clean(), along with the approved tags
-            the clean func removes any tags not on the whitelist
-        3) final conversion done with linkify(),
-            converts any URLs written in plain text into proper <a> links
-        - renders the html version of the body and stores
-            it in body_html
+        - renders the html version of the body with the "post"
+            sanitizer profile and stores it in body_html
+        - rendering is skipped when the body didn't change and shared
+            with every other identical body through the render cache
         """
-        allowed_tags = [
-            "a",
-            "abbr",
-            "acronym",
-            "b",
-            "blockquote",
-            "code",
-            "em",
-            "i",
-            "li",
-            "ol",
-            "pre",
-            "strong",
-            "ul",
-            "h1",
-            "h2",
-            "h3",
-            "p",
-        ]
-        # sanitize to ensure only short list of HTML tags are allowed
-        target.body_html = bleach.linkify(
-            bleach.clean(
-                # server side markdown to html converter
-                markdown(value, output_format="html"),
-                tags=allowed_tags,
-                strip=True,
+        if value == oldvalue and target.body_html is not None:
+            return
+        target.body_html = render_body(value, "post")
+
+    def etag_parts(self):
+        """Values that change whenever to_json() does"""
+        return ("post", self.id, self.version, self.comment_count)
+
+    JSON_FIELDS = {
+        "url": lambda post: url_for("api.get_post", id=post.id),
+        "body": lambda post: post.body,
+        "body_html": lambda post: post.body_html,
+        "timestamp": lambda post: post.timestamp,
+        "author_url": lambda post: url_for("api.get_user", id=post.author_id),
+        "comments_url": lambda post: url_for("api.get_post_comments", id=post.id),
+        "comment_count": lambda post: post.comment_count,
+    }
+
+    def to_json(self, fields=None):
+        return json_fields(self, fields)
+
+    @staticmethod
+    def with_author(query):
+        """Eager load the author columns _posts.html displays"""
+        return query.options(
+            db.joinedload(Post.author).load_only(
+                User.username, User.email, User.avatar_hash
             )
         )
 
-    def to_json(self):
-        json_post = {
-            "url": url_for("api.get_post", id=self.id),
-            "body": self.body,
-            "body_html": self.body_html,
-            "timestamp": self.timestamp,
-            "author_url": url_for("api.get_user", id=self.author_id),
-            "comments_url": url_for("api.get_post_comments", id=self.id),
-            "comment_count": self.comments.count(),
-        }
-        return json_post
+    @staticmethod
+    def recount():
+        """Rebuild the stored comment counter of every post"""
+        posts = Post.__table__
+        comments = Comment.__table__
+        db.session.execute(
+            posts.update().values(
+                comment_count=db.select(db.func.count())
+                .where(comments.c.post_id == posts.c.id)
+                .scalar_subquery()
+            )
+        )
 
     @staticmethod
     def from_json(json_post):
@@ -415,6 +657,67 @@ class AnonymousUser(AnonymousUserMixin):
 login_manager.anonymous_user = AnonymousUser
 
 
+class TokenUser:
+    """The user of a stateless API token, built from the token alone
+
+    It knows the id, confirmed flag and permissions the token was issued
+    with, which is all the API needs to authorize a request. Any other
+    attribute loads the actual User on first use.
+    """
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, data):
+        self.id = data["id"]
+        self.confirmed = data["confirmed"]
+        self.permissions = data["permissions"]
+        self._user = None
+
+    def __repr__(self):
+        return "<TokenUser %r>" % self.id
+
+    def __eq__(self, other):
+        if isinstance(other, (User, TokenUser)):
+            return self.id == other.id
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def get_id(self):
+        return str(self.id)
+
+    def can(self, perm):
+        return self.permissions & perm == perm
+
+    def is_administrator(self):
+        return self.can(Permission.ADMIN)
+
+
+def _detached_instance(model, values):
+    """Add an instance of model with the given loaded values to the
+    session as if it had been queried, bypassing __init__"""
+    instance = model.__mapper__.class_manager.new_instance()
+    for key, value in values.items():
+        set_committed_value(instance, key, value)
+    make_transient_to_detached(instance)
+    db.session.add(instance)
+    return instance
+
+
 @login_manager.user_loader
 def load_user(user_id):
     """Retrieve information about the logged-in user
@@ -427,38 +730,58 @@ def load_user(user_id):
         - None: User identifier is invalid or error occurred
 
     """
-    return User.query.get(int(user_id))
+    snapshot = user_cache.get(int(user_id))
+    if snapshot is not None:
+        return User.from_snapshot(snapshot)
+    # the role is needed by every current_user.can() in the templates
+    user = User.query.options(db.joinedload(User.role)).get(int(user_id))
+    if user is not None:
+        user_cache.set(user.id, user.snapshot())
+    return user
 
 
 class Comment(db.Model):
     __tablename__ = "comments"
+    __table_args__ = (db.Index("ix_comments_timestamp_id", "timestamp", "id"),)
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     disabled = db.Column(db.Boolean, default=False)
+    version = db.Column(db.Integer, default=1, server_default="1")
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
-    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"))
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), index=True)
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ["a", "abbr", "acronym", "b", "code", "em", "i", "strong"]
-        target.body_html = bleach.linkify(
-            bleach.clean(
-                markdown(value, output_format="html"), tags=allowed_tags, strip=True
+        if value == oldvalue and target.body_html is not None:
+            return
+        target.body_html = render_body(value, "comment")
+
+    @staticmethod
+    def with_author(query):
+        """Eager load the author columns _comments.html displays"""
+        return query.options(
+            db.joinedload(Comment.author).load_only(
+                User.username, User.email, User.avatar_hash
             )
         )
 
-    def to_json(self):
-        json_comment = {
-            "url": url_for("api.get_comment", id=self.id),
-            "post_url": url_for("api.get_post", id=self.post_id),
-            "body": self.body,
-            "body_html": self.body_html,
-            "timestamp": self.timestamp,
-            "author_url": url_for("api.get_user", id=self.author_id),
-        }
-        return json_comment
+    def etag_parts(self):
+        """Values that change whenever to_json() does"""
+        return ("comment", self.id, self.version)
+
+    JSON_FIELDS = {
+        "url": lambda comment: url_for("api.get_comment", id=comment.id),
+        "post_url": lambda comment: url_for("api.get_post", id=comment.post_id),
+        "body": lambda comment: comment.body,
+        "body_html": lambda comment: comment.body_html,
+        "timestamp": lambda comment: comment.timestamp,
+        "author_url": lambda comment: url_for("api.get_user", id=comment.author_id),
+    }
+
+    def to_json(self, fields=None):
+        return json_fields(self, fields)
 
     @staticmethod
     def from_json(json_comment):
@@ -469,3 +792,494 @@ class Comment(db.Model):
 
 
 db.event.listen(Comment.body, "set", Comment.on_changed_body)
+
+
+class TimelineEntry(db.Model):
+    """A post copied into the timeline of one of its author's followers
+
+    Rows are written when a post is created (fan-out on write), backfilled
+    when a follow is created and pruned when it is removed. Authors with
+    more than IBLOG_TIMELINE_FANOUT_LIMIT followers are not fanned out,
+    User.followed_posts merges their posts at read time.
+    """
+
+    __tablename__ = "timeline_entries"
+    __table_args__ = (
+        db.Index("ix_timeline_entries_user_author", "user_id", "author_id"),
+        # the followed posts of a user are read in this order
+        db.Index(
+            "ix_timeline_entries_user_timestamp", "user_id", "timestamp", "post_id"
+        ),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    post_id = db.Column(
+        db.Integer, db.ForeignKey("posts.id"), primary_key=True, index=True
+    )
+    author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    # copied from the post, posts are never re-dated
+    timestamp = db.Column(db.DateTime)
+
+    @staticmethod
+    def _fan_out_to(author_id):
+        """Whether author_id is still below the fan-out threshold"""
+        users = User.__table__
+        follower_count = (
+            db.select(users.c.follower_count)
+            .where(users.c.id == author_id)
+            .scalar_subquery()
+        )
+        return follower_count <= current_app.config["IBLOG_TIMELINE_FANOUT_LIMIT"]
+
+    @staticmethod
+    def fan_out(connection, post):
+        """Copy a new post into the timeline of every follower of its author"""
+        follows = Follow.__table__
+        followers = db.select(
+            follows.c.follower_id,
+            db.literal(post.id),
+            db.literal(post.author_id),
+            db.literal(post.timestamp),
+        ).where(
+            follows.c.followed_id == post.author_id,
+            TimelineEntry._fan_out_to(post.author_id),
+        )
+        connection.execute(
+            TimelineEntry.__table__.insert().from_select(
+                ["user_id", "post_id", "author_id", "timestamp"], followers
+            )
+        )
+
+    @staticmethod
+    def backfill(connection, author_id, follower_id=None):
+        """Copy the existing posts of author_id into the timeline of
+        follower_id, or of every follower of author_id when it is None,
+        skipping those already there, with one INSERT ... SELECT"""
+        entries = TimelineEntry.__table__
+        posts = Post.__table__
+        follows = Follow.__table__
+        already = db.exists().where(
+            entries.c.user_id == follows.c.follower_id,
+            entries.c.post_id == posts.c.id,
+        )
+        missing = (
+            db.select(
+                follows.c.follower_id, posts.c.id, posts.c.author_id, posts.c.timestamp
+            )
+            .join(posts, posts.c.author_id == follows.c.followed_id)
+            .where(
+                follows.c.followed_id == author_id,
+                ~already,
+                TimelineEntry._fan_out_to(author_id),
+            )
+        )
+        if follower_id is not None:
+            missing = missing.where(follows.c.follower_id == follower_id)
+        connection.execute(
+            entries.insert().from_select(
+                ["user_id", "post_id", "author_id", "timestamp"], missing
+            )
+        )
+
+    @staticmethod
+    def prune(connection, follower_id, author_id):
+        entries = TimelineEntry.__table__
+        connection.execute(
+            entries.delete().where(
+                entries.c.user_id == follower_id, entries.c.author_id == author_id
+            )
+        )
+
+    @staticmethod
+    def rebuild():
+        """Regenerate every timeline from the follows and posts tables"""
+        entries = TimelineEntry.__table__
+        follows = Follow.__table__
+        posts = Post.__table__
+        users = User.__table__
+        rows = (
+            db.select(
+                follows.c.follower_id, posts.c.id, posts.c.author_id, posts.c.timestamp
+            )
+            .join(posts, posts.c.author_id == follows.c.followed_id)
+            .join(users, users.c.id == follows.c.followed_id)
+            .where(
+                users.c.follower_count
+                <= current_app.config["IBLOG_TIMELINE_FANOUT_LIMIT"]
+            )
+        )
+        db.session.execute(entries.delete())
+        db.session.execute(
+            entries.insert().from_select(
+                ["user_id", "post_id", "author_id", "timestamp"], rows
+            )
+        )
+
+
+class PostScore(db.Model):
+    """Time-decayed activity score of a recently created or commented post
+
+    Every event (the post being created, a comment on it) counts for
+    2^(-age / IBLOG_TRENDING_HALF_LIFE). Instead of decaying every score
+    as time passes, scores are kept as the log of the events' weights
+    relative to a fixed epoch, which only ever grow and compare the same
+    as the decayed values at any instant. Adding an event is then a single
+    UPDATE of one row, and the trending posts are read off the score index.
+    compact() recomputes the scores from the rows of the last
+    IBLOG_TRENDING_WINDOW hours, forgetting older posts and correcting for
+    deleted or disabled comments.
+    """
+
+    __tablename__ = "post_scores"
+    EPOCH = datetime(2020, 1, 1)
+    post_id = db.Column(
+        db.Integer, db.ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True
+    )
+    score = db.Column(db.Float, nullable=False, index=True)
+
+    @staticmethod
+    def term(timestamp):
+        """log of the weight, relative to EPOCH, of an event at timestamp"""
+        half_life = current_app.config["IBLOG_TRENDING_HALF_LIFE"] * 3600
+        seconds = (timestamp - PostScore.EPOCH).total_seconds()
+        return seconds * math.log(2) / half_life
+
+    @staticmethod
+    def bump(connection, post_id, timestamp):
+        """Add an event at timestamp to the score of post_id"""
+        scores = PostScore.__table__
+        term = PostScore.term(timestamp or datetime.utcnow())
+        # log(exp(score) + exp(term)), without overflowing exp()
+        added = db.case(
+            (
+                scores.c.score > term,
+                scores.c.score + db.func.ln(1 + db.func.exp(term - scores.c.score)),
+            ),
+            else_=term + db.func.ln(1 + db.func.exp(scores.c.score - term)),
+        )
+        updated = connection.execute(
+            scores.update().where(scores.c.post_id == post_id).values(score=added)
+        )
+        if updated.rowcount == 0:
+            connection.execute(scores.insert().values(post_id=post_id, score=term))
+
+    @staticmethod
+    def compact(now=None):
+        """Recompute the scores from the posts and comments of the window
+
+        Runs in the current transaction, the caller commits.
+        Returns the number of scored posts.
+        """
+        now = now or datetime.utcnow()
+        since = now - timedelta(hours=current_app.config["IBLOG_TRENDING_WINDOW"])
+        posts = Post.__table__
+        comments = Comment.__table__
+        events = db.union_all(
+            db.select(posts.c.id, posts.c.timestamp).where(posts.c.timestamp >= since),
+            db.select(comments.c.post_id, comments.c.timestamp).where(
+                comments.c.timestamp >= since,
+                comments.c.disabled.isnot(True),
+            ),
+        )
+        # sum the weights relative to now, where they are at most 1
+        reference = PostScore.term(now)
+        weights = {}
+        for post_id, timestamp in db.session.execute(events):
+            weights[post_id] = weights.get(post_id, 0.0) + math.exp(
+                PostScore.term(timestamp) - reference
+            )
+        # comments of posts deleted without their comments
+        existing = db.select(posts.c.id).where(posts.c.id.in_(list(weights)))
+        kept = set(db.session.execute(existing).scalars())
+        scores = PostScore.__table__
+        db.session.execute(scores.delete())
+        rows = [
+            {"post_id": post_id, "score": reference + math.log(weight)}
+            for post_id, weight in weights.items()
+            if post_id in kept
+        ]
+        if rows:
+            db.session.execute(scores.insert(), rows)
+        return len(rows)
+
+    @staticmethod
+    def trending_posts():
+        """Query of the scored posts, highest score first"""
+        return Post.query.join(PostScore, PostScore.post_id == Post.id).order_by(
+            PostScore.score.desc(), Post.id.desc()
+        )
+
+
+@db.event.listens_for(db.Session, "do_orm_execute")
+def check_lazy_load(orm_execute_state):
+    """Enforces the no_lazy_loads view decorator"""
+    if not orm_execute_state.is_relationship_load:
+        return
+    if not has_app_context() or not g.get("forbid_lazy_loads"):
+        return
+    parent = orm_execute_state.lazy_loaded_from
+    # the logged in user is loaded once per request, not per row
+    if parent is not None and parent.obj() is current_user._get_current_object():
+        return
+    raise LazyLoadError(
+        "lazy load of %s from %r"
+        % (orm_execute_state.loader_strategy_path, parent and parent.obj())
+    )
+
+
+def on_row_updating(mapper, connection, target):
+    # before_update also sees objects that were modified back to their
+    # original values, those keep their version
+    if db.object_session(target).is_modified(target, include_collections=False):
+        target.version = (target.version or 0) + 1
+
+
+for model in (User, Post, Comment):
+    db.event.listen(model, "before_update", on_row_updating)
+
+
+def on_user_changed(mapper, connection, target):
+    user_cache.delete(target.id)
+    token_generation_cache.delete(target.id)
+
+
+def on_user_updating(mapper, connection, target):
+    # stateless tokens embed these, so changing them revokes the tokens
+    state = db.inspect(target)
+    for column in ("confirmed", "role_id", "password_hash"):
+        if state.attrs[column].history.has_changes():
+            target.token_generation = (target.token_generation or 0) + 1
+            break
+
+
+def on_role_changed(mapper, connection, target):
+    # permissions are part of every cached user snapshot
+    user_cache.clear()
+
+
+# drop the cached snapshots of users whose rows are modified through the
+# ORM, e.g. by edit_profile, edit_profile_admin, confirm or change_email
+db.event.listen(User, "before_update", on_user_updating)
+db.event.listen(User, "after_update", on_user_changed)
+db.event.listen(User, "after_delete", on_user_changed)
+db.event.listen(Role, "after_update", on_role_changed)
+
+
+def on_post_written(mapper, connection, target):
+    # the post listings and the author's profile show every post
+    invalidate_on_commit(
+        target, "posts", "post:%s" % target.id, "user:%s" % target.author_id
+    )
+
+
+def on_post_updated(mapper, connection, target):
+    invalidate_on_commit(target, "post:%s" % target.id)
+
+
+def on_comment_written(mapper, connection, target):
+    # comment counts are shown wherever the post is
+    invalidate_on_commit(target, "post:%s" % target.post_id)
+
+
+def on_user_written(mapper, connection, target):
+    invalidate_on_commit(target, "user:%s" % target.id)
+
+
+def on_follow_written(mapper, connection, target):
+    invalidate_on_commit(
+        target, "user:%s" % target.follower_id, "user:%s" % target.followed_id
+    )
+
+
+# invalidate the cached anonymous pages showing rows that were written
+db.event.listen(Post, "after_insert", on_post_written)
+db.event.listen(Post, "after_update", on_post_updated)
+db.event.listen(Post, "after_delete", on_post_written)
+db.event.listen(Comment, "after_insert", on_comment_written)
+db.event.listen(Comment, "after_update", on_comment_written)
+db.event.listen(Comment, "after_delete", on_comment_written)
+db.event.listen(User, "after_update", on_user_written)
+db.event.listen(User, "after_delete", on_user_written)
+db.event.listen(Follow, "after_insert", on_follow_written)
+db.event.listen(Follow, "after_delete", on_follow_written)
+
+
+def on_post_indexed(mapper, connection, target):
+    index_document(connection, "post", target.id, target.body)
+
+
+def on_post_edited(mapper, connection, target):
+    # the same body changes that re-render body_html
+    if db.inspect(target).attrs.body.history.has_changes():
+        index_document(connection, "post", target.id, target.body)
+
+
+def on_post_unindexed(mapper, connection, target):
+    remove_document(connection, "post", target.id)
+
+
+def on_comment_indexed(mapper, connection, target):
+    state = db.inspect(target)
+    if not (
+        state.attrs.body.history.has_changes()
+        or state.attrs.disabled.history.has_changes()
+    ):
+        return
+    # disabled comments are not shown, so they are not found either
+    if target.disabled:
+        remove_document(connection, "comment", target.id)
+    else:
+        index_document(connection, "comment", target.id, target.body)
+
+
+def on_comment_unindexed(mapper, connection, target):
+    remove_document(connection, "comment", target.id)
+
+
+# keep the search index in step with the bodies, in the same transaction
+db.event.listen(Post, "after_insert", on_post_indexed)
+db.event.listen(Post, "after_update", on_post_edited)
+db.event.listen(Post, "after_delete", on_post_unindexed)
+db.event.listen(Comment, "after_insert", on_comment_indexed)
+db.event.listen(Comment, "after_update", on_comment_indexed)
+db.event.listen(Comment, "after_delete", on_comment_unindexed)
+
+
+def on_post_scored(mapper, connection, target):
+    PostScore.bump(connection, target.id, target.timestamp)
+
+
+def on_comment_scored(mapper, connection, target):
+    PostScore.bump(connection, target.post_id, target.timestamp)
+
+
+def on_post_unscored(mapper, connection, target):
+    scores = PostScore.__table__
+    connection.execute(scores.delete().where(scores.c.post_id == target.id))
+
+
+# new posts and comments count toward trending as they are written
+db.event.listen(Post, "after_insert", on_post_scored)
+db.event.listen(Post, "after_delete", on_post_unscored)
+db.event.listen(Comment, "after_insert", on_comment_scored)
+
+
+def adjust_counter(connection, model, id, column, delta, instance=None):
+    """Atomically add delta to one of the denormalized counter columns
+
+    The UPDATE runs on the flushing connection so it is part of the same
+    transaction as the row that caused it. An instance of the parent that
+    is already loaded is kept in step without marking it as modified, as
+    that would write its stale value back on the next flush.
+    """
+    table = model.__table__
+    connection.execute(
+        table.update().where(table.c.id == id).values({column: table.c[column] + delta})
+    )
+    if instance is not None and instance.__dict__.get(column) is not None:
+        set_committed_value(instance, column, instance.__dict__[column] + delta)
+
+
+def on_post_inserted(mapper, connection, target):
+    adjust_counter(
+        connection,
+        User,
+        target.author_id,
+        "post_count",
+        1,
+        target.__dict__.get("author"),
+    )
+    TimelineEntry.fan_out(connection, target)
+
+
+def on_post_deleted(mapper, connection, target):
+    adjust_counter(
+        connection,
+        User,
+        target.author_id,
+        "post_count",
+        -1,
+        target.__dict__.get("author"),
+    )
+    entries = TimelineEntry.__table__
+    connection.execute(entries.delete().where(entries.c.post_id == target.id))
+
+
+def on_comment_inserted(mapper, connection, target):
+    adjust_counter(
+        connection,
+        Post,
+        target.post_id,
+        "comment_count",
+        1,
+        target.__dict__.get("post"),
+    )
+
+
+def on_comment_deleted(mapper, connection, target):
+    adjust_counter(
+        connection,
+        Post,
+        target.post_id,
+        "comment_count",
+        -1,
+        target.__dict__.get("post"),
+    )
+
+
+def on_follow_inserted(mapper, connection, target):
+    adjust_counter(
+        connection,
+        User,
+        target.follower_id,
+        "followed_count",
+        1,
+        target.__dict__.get("follower"),
+    )
+    adjust_counter(
+        connection,
+        User,
+        target.followed_id,
+        "follower_count",
+        1,
+        target.__dict__.get("followed"),
+    )
+    TimelineEntry.backfill(connection, target.followed_id, target.follower_id)
+
+
+def on_follow_deleted(mapper, connection, target):
+    adjust_counter(
+        connection,
+        User,
+        target.follower_id,
+        "followed_count",
+        -1,
+        target.__dict__.get("follower"),
+    )
+    adjust_counter(
+        connection,
+        User,
+        target.followed_id,
+        "follower_count",
+        -1,
+        target.__dict__.get("followed"),
+    )
+    TimelineEntry.prune(connection, target.follower_id, target.followed_id)
+    # an author who just dropped back to the fan-out threshold has to be
+    # copied into the timelines of the followers that were merging them
+    users = User.__table__
+    follower_count = connection.execute(
+        db.select(users.c.follower_count).where(users.c.id == target.followed_id)
+    ).scalar()
+    if follower_count == current_app.config["IBLOG_TIMELINE_FANOUT_LIMIT"]:
+        TimelineEntry.backfill(connection, target.followed_id)
+
+
+# keep the denormalized counters and the timelines in step with the rows
+# they are derived from; these run inside the flush, so they commit or roll back together
+# with the rows they were triggered by
+db.event.listen(Post, "after_insert", on_post_inserted)
+db.event.listen(Post, "after_delete", on_post_deleted)
+db.event.listen(Comment, "after_insert", on_comment_inserted)
+db.event.listen(Comment, "after_delete", on_comment_deleted)
+db.event.listen(Follow, "after_insert", on_follow_inserted)
+db.event.listen(Follow, "after_delete", on_follow_deleted)
@@ -0,0 +1,233 @@
+import os
+import pickle
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_app_context, make_response, request, session
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from .cache import LRUCache
+
+
+class LRUBackend:
+    """Pages kept in the memory of each worker"""
+
+    def __init__(self, maxsize, ttl):
+        self._cache = LRUCache(maxsize, ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class SQLiteBackend:
+    """Pages kept in a SQLite file shared by every worker on the host"""
+
+    def __init__(self, path, maxsize, ttl):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS page_cache "
+                "(key TEXT PRIMARY KEY, value BLOB, expires REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_page_cache_expires "
+                "ON page_cache (expires)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # the context manager of a sqlite3 connection ends a transaction,
+        # it does not close the connection
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def get(self, key):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT value FROM page_cache WHERE key = ? AND expires > ?",
+                (key, time.time()),
+            ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO page_cache VALUES (?, ?, ?)",
+                (key, pickle.dumps(value), now + self.ttl),
+            )
+            connection.execute("DELETE FROM page_cache WHERE expires <= ?", (now,))
+            # keep the newest maxsize entries
+            connection.execute(
+                "DELETE FROM page_cache WHERE key IN (SELECT key FROM page_cache "
+                "ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM page_cache")
+
+
+class PageCache:
+    """Full-page cache for the GET requests of anonymous users
+
+    Pages are keyed by path and query string. While a cached view runs it
+    tags the page with the rows it shows ("post:1", "user:2", "posts" for
+    the post listings), commits touching those rows invalidate the tags.
+    Invalidation bumps a random version per tag, a page is only served if
+    the versions of its tags are unchanged, which works the same with every
+    backend.
+
+    IBLOG_PAGE_CACHE picks the backend: "lru" (in-process, the default),
+    "sqlite" (a file shared by the workers of a host, at
+    IBLOG_PAGE_CACHE_PATH) or "" to disable the cache.
+    """
+
+    def init_app(self, app):
+        backend = app.config["IBLOG_PAGE_CACHE"]
+        size = app.config["IBLOG_PAGE_CACHE_SIZE"]
+        ttl = app.config["IBLOG_PAGE_CACHE_TTL"]
+        if backend == "lru":
+            app.extensions["page_cache"] = LRUBackend(size, ttl)
+        elif backend == "sqlite":
+            path = app.config["IBLOG_PAGE_CACHE_PATH"]
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            app.extensions["page_cache"] = SQLiteBackend(path, size, ttl)
+        elif backend:
+            raise ValueError("unknown IBLOG_PAGE_CACHE backend %r" % backend)
+        else:
+            app.extensions["page_cache"] = None
+
+    @property
+    def backend(self):
+        if not has_app_context():
+            return None
+        return current_app.extensions.get("page_cache")
+
+    def _tag_version(self, tag, create=True):
+        version = self.backend.get("tag:" + tag)
+        if version is None and create:
+            # a tag without a version (never seen or evicted) is given a
+            # new one, which invalidates any page recorded with the old one
+            version = uuid.uuid4().hex
+            self.backend.set("tag:" + tag, version)
+        return version
+
+    def tag(self, *tags):
+        """Record that the page being rendered shows the given rows
+
+        The page is stored under the versions the tags have now, before it
+        is rendered, so a commit invalidating them meanwhile discards it.
+        """
+        if "page_cache_tags" in g:
+            for tag in tags:
+                if tag not in g.page_cache_tags:
+                    g.page_cache_tags[tag] = self._tag_version(tag)
+
+    def invalidate(self, *tags):
+        if self.backend is None:
+            return
+        for tag in tags:
+            self.backend.set("tag:" + tag, uuid.uuid4().hex)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def _lookup(self, key):
+        entry = self.backend.get("page:" + key)
+        if entry is None:
+            return None
+        for tag, version in entry["tags"].items():
+            if self._tag_version(tag, create=False) != version:
+                return None
+        response = current_app.response_class(
+            entry["body"], status=entry["status"], headers=entry["headers"]
+        )
+        return response
+
+    def _store(self, key, response, tags):
+        self.backend.set(
+            "page:" + key,
+            {
+                "body": response.get_data(),
+                "status": response.status_code,
+                "headers": [
+                    (name, value)
+                    for name, value in response.headers.items()
+                    if name.lower() != "set-cookie"
+                ],
+                "tags": tags,
+            },
+        )
+
+    def cached(self, f):
+        """Serve the view from the cache to anonymous users"""
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if (
+                self.backend is None
+                or request.method != "GET"
+                or current_user.is_authenticated
+                # flashed messages are rendered once, into this page only
+                or session.get("_flashes")
+            ):
+                return f(*args, **kwargs)
+            key = request.full_path
+            response = self._lookup(key)
+            if response is not None:
+                return response
+            g.page_cache_tags = {}
+            try:
+                response = make_response(f(*args, **kwargs))
+                tags = g.page_cache_tags
+            finally:
+                g.pop("page_cache_tags", None)
+            if (
+                response.status_code == 200
+                and not response.direct_passthrough
+                and not session.modified
+            ):
+                self._store(key, response, tags)
+            return response
+
+        return decorated_function
+
+
+def invalidate_on_commit(target, *tags):
+    """Invalidate the page cache tags once the session of target commits"""
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("page_cache_tags", set()).update(tags)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    tags = session.info.pop("page_cache_tags", None)
+    if tags and has_app_context():
+        from . import page_cache
+
+        page_cache.invalidate(*tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_rolled_back(session):
+    session.info.pop("page_cache_tags", None)
@@ -0,0 +1,95 @@
+import atexit
+import logging
+import threading
+import time
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+class LastSeenBuffer:
+    """Write-behind buffer for User.last_seen
+
+    User.ping() runs on every authenticated request, writing each one
+    through would turn every page view into a write transaction. Instead
+    the newest time seen for each user is kept in memory by this worker
+    and written out as one batched UPDATE every
+    IBLOG_LAST_SEEN_FLUSH_INTERVAL seconds, and when the worker exits.
+    """
+
+    def init_app(self, app):
+        app.extensions["last_seen_buffer"] = {
+            "lock": threading.Lock(),
+            "pending": {},
+            "flushed_at": time.monotonic(),
+        }
+        atexit.register(self._flush_at_exit, app)
+
+    def _state(self):
+        return current_app.extensions["last_seen_buffer"]
+
+    def record(self, user_id, timestamp):
+        """Buffer timestamp as the last time user_id was seen"""
+        state = self._state()
+        with state["lock"]:
+            pending = state["pending"]
+            # several requests of a user coalesce into a single row update
+            if user_id not in pending or pending[user_id] < timestamp:
+                pending[user_id] = timestamp
+            due = (
+                time.monotonic() - state["flushed_at"]
+                >= current_app.config["IBLOG_LAST_SEEN_FLUSH_INTERVAL"]
+            )
+        if due:
+            self.flush()
+
+    def pending(self):
+        """Number of users waiting to be written out"""
+        return len(self._state()["pending"])
+
+    def flush(self):
+        """Write the buffered times with one executemany UPDATE
+
+        Runs on its own connection and transaction so it never commits
+        the work of the request that happened to trigger it. A failed
+        write, such as SQLite's "database is locked", is logged and its
+        times are buffered again for the next flush instead of failing
+        that request. Returns the number of rows written.
+        """
+        from . import db
+        from .models import User
+
+        state = self._state()
+        with state["lock"]:
+            pending, state["pending"] = state["pending"], {}
+            state["flushed_at"] = time.monotonic()
+        if not pending:
+            return 0
+        users = User.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    users.update()
+                    .where(users.c.id == db.bindparam("_id"))
+                    .values(last_seen=db.bindparam("_last_seen")),
+                    [
+                        {"_id": user_id, "_last_seen": timestamp}
+                        for user_id, timestamp in pending.items()
+                    ],
+                )
+        except Exception:
+            logger.exception("could not write the last_seen of %d users", len(pending))
+            with state["lock"]:
+                # keep the newer time of users seen again meanwhile
+                for user_id, timestamp in pending.items():
+                    current = state["pending"].get(user_id)
+                    if current is None or current < timestamp:
+                        state["pending"][user_id] = timestamp
+            return 0
+        return len(pending)
+
+    def _flush_at_exit(self, app):
+        with app.app_context():
+            if self.pending():
+                self.flush()
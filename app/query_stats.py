@@ -0,0 +1,107 @@
+import re
+import threading
+import time
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# literals and expanded IN lists, in the order they are replaced
+_NORMALIZERS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?, ...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def fingerprint(statement):
+    """statement with its literals replaced by ? and IN lists collapsed,
+    so queries differing only in their parameters add up together"""
+    for pattern, replacement in _NORMALIZERS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class QueryStats:
+    """Per-worker totals of the queries run by requests, grouped by
+    fingerprint
+
+    For every fingerprint the number of runs, their total and longest
+    duration and the endpoints that issued them are kept. At most
+    IBLOG_QUERY_STATS_SIZE fingerprints are tracked, queries with new
+    fingerprints past that only count in "untracked".
+    """
+
+    def init_app(self, app):
+        app.extensions["query_stats"] = {
+            "lock": threading.Lock(),
+            "queries": {},
+            "untracked": 0,
+        }
+
+    def _state(self):
+        return current_app.extensions["query_stats"]
+
+    def record(self, statement, duration, endpoint):
+        state = self._state()
+        key = fingerprint(statement)
+        with state["lock"]:
+            stats = state["queries"].get(key)
+            if stats is None:
+                if (
+                    len(state["queries"])
+                    >= current_app.config["IBLOG_QUERY_STATS_SIZE"]
+                ):
+                    state["untracked"] += 1
+                    return
+                stats = state["queries"][key] = {
+                    "count": 0,
+                    "total": 0.0,
+                    "max": 0.0,
+                    "endpoints": {},
+                }
+            stats["count"] += 1
+            stats["total"] += duration
+            stats["max"] = max(stats["max"], duration)
+            stats["endpoints"][endpoint] = stats["endpoints"].get(endpoint, 0) + 1
+
+    def report(self):
+        """The tracked fingerprints, costliest overall first"""
+        state = self._state()
+        with state["lock"]:
+            report = [
+                {
+                    "fingerprint": key,
+                    "count": stats["count"],
+                    "total": stats["total"],
+                    "mean": stats["total"] / stats["count"],
+                    "max": stats["max"],
+                    "endpoints": dict(stats["endpoints"]),
+                }
+                for key, stats in state["queries"].items()
+            ]
+            untracked = state["untracked"]
+        report.sort(key=lambda stats: stats["total"], reverse=True)
+        return report, untracked
+
+    def reset(self):
+        state = self._state()
+        with state["lock"]:
+            state["queries"] = {}
+            state["untracked"] = 0
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context():
+        context.query_stats_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "query_stats_start", None)
+    if start is not None and has_request_context():
+        from . import query_stats
+
+        query_stats.record(statement, time.perf_counter() - start, request.endpoint)
@@ -0,0 +1,141 @@
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import bleach
+from markdown import markdown
+
+from . import db, render_cache, request_timing
+
+# the HTML tags each kind of body may keep after sanitizing
+SANITIZER_PROFILES = {
+    "post": [
+        "a",
+        "abbr",
+        "acronym",
+        "b",
+        "blockquote",
+        "code",
+        "em",
+        "i",
+        "li",
+        "ol",
+        "pre",
+        "strong",
+        "ul",
+        "h1",
+        "h2",
+        "h3",
+        "p",
+    ],
+    "comment": ["a", "abbr", "acronym", "b", "code", "em", "i", "strong"],
+}
+
+
+def render_markdown(body, profile):
+    """
+    Handles the conversion of Markdown text to HTML
+    Steps:
+    1) markdown() func does initial conversion to HTML
+    2) result passed to clean(), along with the approved tags of the
+        profile, the clean func removes any tags not on the whitelist
+    3) final conversion done with linkify(),
+        converts any URLs written in plain text into proper <a> links
+    """
+    # sanitize to ensure only short list of HTML tags are allowed
+    return bleach.linkify(
+        bleach.clean(
+            # server side markdown to html converter
+            markdown(body, output_format="html"),
+            tags=SANITIZER_PROFILES[profile],
+            strip=True,
+        )
+    )
+
+
+def render_body(body, profile):
+    """render_markdown() behind the application's render cache
+
+    Entries are keyed by the profile and the sha256 of the body, so
+    resending an unchanged body or generating many identical ones only
+    runs the pipeline once. Hit and miss counts are in render_cache.info().
+    """
+    key = (profile, hashlib.sha256(body.encode("utf-8")).hexdigest())
+    html = render_cache.get(key)
+    if html is None:
+        with request_timing.measure("md"):
+            html = render_markdown(body, profile)
+        render_cache.set(key, html)
+    return html
+
+
+def _render_batch(profile, rows):
+    """Render a batch of (id, body, body_html) rows, keeping only the ids
+    whose body_html changed; runs in the worker processes of rerender()"""
+    rendered = []
+    for id, body, body_html in rows:
+        html = render_markdown(body, profile) if body is not None else None
+        if html != body_html:
+            rendered.append({"_id": id, "_body_html": html})
+    return rendered
+
+
+def rerender(model, profile, workers=1, batch_size=500, after_id=0, progress=None):
+    """Regenerate body_html for every row of model after after_id
+
+    Rows are read in id order in batches of batch_size, rendered by a pool
+    of worker processes and written back with one executemany UPDATE per
+    batch, only for the rows whose html changed. Every batch is committed
+    in order, so progress(rows_done, last_id) is called with the id an
+    interrupted run can be resumed after.
+    Returns the number of rows rewritten.
+    """
+    table = model.__table__
+    update = (
+        table.update().where(table.c.id == db.bindparam("_id"))
+        # the new version invalidates the ETags and fragments of the row
+        .values(body_html=db.bindparam("_body_html"), version=table.c.version + 1)
+    )
+
+    def read_batch(after):
+        return db.session.execute(
+            db.select(table.c.id, table.c.body, table.c.body_html)
+            .where(table.c.id > after)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).all()
+
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    in_flight = deque()
+    read_id = after_id
+    done = changed = 0
+    exhausted = False
+    try:
+        while True:
+            # keep every worker busy while the oldest batch is written
+            while not exhausted and len(in_flight) < max(workers, 1) * 2:
+                rows = [tuple(row) for row in read_batch(read_id)]
+                if not rows:
+                    exhausted = True
+                    break
+                read_id = rows[-1][0]
+                if pool is not None:
+                    batch = pool.submit(_render_batch, profile, rows)
+                else:
+                    batch = _render_batch(profile, rows)
+                in_flight.append((rows[-1][0], len(rows), batch))
+            if not in_flight:
+                break
+            last_id, count, batch = in_flight.popleft()
+            rendered = batch.result() if pool is not None else batch
+            if rendered:
+                db.session.execute(update, rendered)
+            db.session.commit()
+            done += count
+            changed += len(rendered)
+            if progress is not None:
+                progress(done, last_id)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return changed
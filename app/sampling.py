@@ -0,0 +1,180 @@
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, request
+
+
+def _frame_name(code):
+    # the last two path components tell apart the many __init__.py
+    path = "/".join(code.co_filename.replace(os.sep, "/").split("/")[-2:])
+    return "%s (%s:%d)" % (code.co_name, path, code.co_firstlineno)
+
+
+class SamplingProfiler:
+    """On demand sampling profiler for the requests of this worker
+
+    Admins arm it for the next N requests, optionally only those of one
+    endpoint, and requests carrying the IBLOG_PROFILER_TOKEN in their
+    X-Profile header are always profiled. While a profiled request runs a
+    background thread records its stack every IBLOG_PROFILER_INTERVAL
+    seconds, when it ends the samples are written to IBLOG_PROFILER_DIR as
+    a collapsed stacks file (for flamegraph.pl and friends) and a
+    speedscope profile. Requests that are not profiled pay one dict lookup.
+    """
+
+    def init_app(self, app):
+        app.extensions["sampling_profiler"] = {
+            "lock": threading.Lock(),
+            "endpoint": None,
+            "remaining": 0,
+            # profiled requests by the id of the thread serving them
+            "active": {},
+            "sampler": None,
+            "written": [],
+        }
+        app.before_request(self._start)
+        app.teardown_request(self._stop)
+
+    def _state(self):
+        return current_app.extensions["sampling_profiler"]
+
+    def arm(self, requests, endpoint=None):
+        """Profile the next requests requests of endpoint (any if None)"""
+        state = self._state()
+        with state["lock"]:
+            state["remaining"] = requests
+            state["endpoint"] = endpoint or None
+
+    def status(self):
+        state = self._state()
+        with state["lock"]:
+            return {
+                "remaining": state["remaining"],
+                "endpoint": state["endpoint"],
+                "written": list(state["written"]),
+            }
+
+    def _wanted(self, state):
+        token = current_app.config["IBLOG_PROFILER_TOKEN"]
+        if token and hmac.compare_digest(
+            request.headers.get("X-Profile", "").encode("utf-8"),
+            token.encode("utf-8"),
+        ):
+            return True
+        with state["lock"]:
+            if state["remaining"] > 0 and state["endpoint"] in (
+                None,
+                request.endpoint,
+            ):
+                state["remaining"] -= 1
+                return True
+        return False
+
+    def _start(self):
+        state = self._state()
+        if not state["remaining"] and not current_app.config["IBLOG_PROFILER_TOKEN"]:
+            return
+        if not self._wanted(state):
+            return
+        with state["lock"]:
+            state["active"][threading.get_ident()] = {
+                "endpoint": request.endpoint,
+                "start": time.perf_counter(),
+                "samples": [],
+            }
+            if state["sampler"] is None:
+                state["sampler"] = threading.Thread(
+                    target=self._sample,
+                    args=(state, current_app.config["IBLOG_PROFILER_INTERVAL"]),
+                    daemon=True,
+                )
+                state["sampler"].start()
+
+    def _sample(self, state, interval):
+        while True:
+            with state["lock"]:
+                if not state["active"]:
+                    state["sampler"] = None
+                    return
+                profiles = list(state["active"].items())
+            frames = sys._current_frames()
+            for thread_id, profile in profiles:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                # root first, like flame graphs read
+                profile["samples"].append(tuple(reversed(stack)))
+            time.sleep(interval)
+
+    def _stop(self, exc=None):
+        state = self._state()
+        if not state["active"]:
+            return
+        with state["lock"]:
+            profile = state["active"].pop(threading.get_ident(), None)
+        if profile is None:
+            return
+        elapsed = time.perf_counter() - profile["start"]
+        path = self._write(profile, elapsed)
+        with state["lock"]:
+            state["written"] = (state["written"] + [path])[-20:]
+
+    def _write(self, profile, elapsed):
+        """Write the collapsed stacks and speedscope files of a profile,
+        returns their path without the extension"""
+        directory = current_app.config["IBLOG_PROFILER_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        name = "%s-%s-%d-%d" % (
+            time.strftime("%Y%m%d-%H%M%S"),
+            profile["endpoint"] or "unknown",
+            os.getpid(),
+            threading.get_ident(),
+        )
+        path = os.path.join(directory, name)
+        interval = current_app.config["IBLOG_PROFILER_INTERVAL"] * 1000
+
+        stacks = Counter(profile["samples"])
+        with open(path + ".collapsed", "w") as f:
+            for stack, count in stacks.most_common():
+                f.write("%s %d\n" % (";".join(map(_frame_name, stack)), count))
+
+        frames = {}
+        samples = []
+        for stack in profile["samples"]:
+            samples.append([frames.setdefault(code, len(frames)) for code in stack])
+        speedscope = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "iblog",
+            "shared": {
+                "frames": [
+                    {
+                        "name": code.co_name,
+                        "file": code.co_filename,
+                        "line": code.co_firstlineno,
+                    }
+                    for code in frames
+                ]
+            },
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": "%s (%.1f ms)" % (profile["endpoint"], elapsed * 1000),
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": interval * len(samples),
+                    "samples": samples,
+                    "weights": [interval] * len(samples),
+                }
+            ],
+        }
+        with open(path + ".speedscope.json", "w") as f:
+            json.dump(speedscope, f)
+        return path
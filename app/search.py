@@ -0,0 +1,285 @@
+import base64
+import binascii
+import json
+import re
+from collections import namedtuple
+
+from . import db
+from .exceptions import ValidationError
+
+# posts and comments share one index, a document id is the row id shifted
+# left by one bit with the kind in the low bit, so a single integer key
+# addresses either and the kind never has to be stored
+KINDS = ("post", "comment")
+
+# at most this many words of a query are searched for
+MAX_TERMS = 16
+
+Hit = namedtuple("Hit", ["kind", "id", "rank"])
+
+
+def document_id(kind, id):
+    return id * 2 + KINDS.index(kind)
+
+
+def terms(query):
+    """The words of query, each must appear in a matching document"""
+    return re.findall(r"\w+", query.lower())[:MAX_TERMS]
+
+
+class FTS5Backend:
+    """SQLite FTS5 virtual table ranked by bm25()
+
+    Used for development and tests; the porter tokenizer makes "running"
+    match "run".
+    """
+
+    create = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index "
+        "USING fts5(body, tokenize = 'porter unicode61')",
+    ]
+    drop = ["DROP TABLE IF EXISTS search_index"]
+
+    def put(self, connection, docid, body):
+        self.delete(connection, docid)
+        connection.execute(
+            db.text("INSERT INTO search_index (rowid, body) VALUES (:docid, :body)"),
+            {"docid": docid, "body": body or ""},
+        )
+
+    def delete(self, connection, docid):
+        connection.execute(
+            db.text("DELETE FROM search_index WHERE rowid = :docid"), {"docid": docid}
+        )
+
+    def find(self, connection, words, limit, after=None):
+        # every word is quoted so FTS5 operators in the query are literal
+        params = {"match": " ".join('"%s"' % word for word in words), "limit": limit}
+        seek = ""
+        if after is not None:
+            seek = "AND (rank > :rank OR (rank = :rank AND rowid > :docid)) "
+            params["rank"], params["docid"] = after
+        return connection.execute(
+            db.text(
+                "SELECT rowid, rank FROM search_index WHERE search_index MATCH :match "
+                + seek
+                + "ORDER BY rank, rowid LIMIT :limit"
+            ),
+            params,
+        ).all()
+
+    def rebuild(self, connection):
+        connection.execute(db.text("DELETE FROM search_index"))
+        connection.execute(
+            db.text(
+                "INSERT INTO search_index (rowid, body) "
+                "SELECT id * 2, coalesce(body, '') FROM posts"
+            )
+        )
+        connection.execute(
+            db.text(
+                "INSERT INTO search_index (rowid, body) "
+                "SELECT id * 2 + 1, coalesce(body, '') FROM comments "
+                "WHERE disabled IS NOT TRUE"
+            )
+        )
+        # merge the b-trees written by the bulk insert
+        connection.execute(
+            db.text("INSERT INTO search_index (search_index) VALUES ('optimize')")
+        )
+
+
+class TSVectorBackend:
+    """Postgres tsvector column behind a GIN index, ranked by ts_rank_cd()
+
+    Ranks are negated so that, as with bm25(), the best match sorts first.
+    """
+
+    create = [
+        "CREATE TABLE IF NOT EXISTS search_index "
+        "(rowid BIGINT PRIMARY KEY, document TSVECTOR NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_search_index_document "
+        "ON search_index USING GIN (document)",
+    ]
+    drop = ["DROP TABLE IF EXISTS search_index"]
+
+    def put(self, connection, docid, body):
+        connection.execute(
+            db.text(
+                "INSERT INTO search_index (rowid, document) "
+                "VALUES (:docid, to_tsvector('english', :body)) "
+                "ON CONFLICT (rowid) DO UPDATE SET document = EXCLUDED.document"
+            ),
+            {"docid": docid, "body": body or ""},
+        )
+
+    def delete(self, connection, docid):
+        connection.execute(
+            db.text("DELETE FROM search_index WHERE rowid = :docid"), {"docid": docid}
+        )
+
+    def find(self, connection, words, limit, after=None):
+        params = {"match": " ".join(words), "limit": limit}
+        seek = ""
+        if after is not None:
+            seek = "WHERE (rank, rowid) > (:rank, :docid) "
+            params["rank"], params["docid"] = after
+        return connection.execute(
+            db.text(
+                "SELECT rowid, rank FROM (SELECT rowid, "
+                "-CAST(ts_rank_cd(document, query) AS DOUBLE PRECISION) AS rank "
+                "FROM search_index, plainto_tsquery('english', :match) query "
+                "WHERE document @@ query) hits "
+                + seek
+                + "ORDER BY rank, rowid LIMIT :limit"
+            ),
+            params,
+        ).all()
+
+    def rebuild(self, connection):
+        connection.execute(db.text("TRUNCATE search_index"))
+        connection.execute(
+            db.text(
+                "INSERT INTO search_index (rowid, document) "
+                "SELECT id * 2, to_tsvector('english', coalesce(body, '')) "
+                "FROM posts"
+            )
+        )
+        connection.execute(
+            db.text(
+                "INSERT INTO search_index (rowid, document) "
+                "SELECT id * 2 + 1, to_tsvector('english', coalesce(body, '')) "
+                "FROM comments WHERE disabled IS NOT TRUE"
+            )
+        )
+
+
+class ScanBackend:
+    """Unranked LIKE scan of the bodies, for databases without a backend
+
+    Nothing is maintained, searching reads every post and comment.
+    """
+
+    create = []
+    drop = []
+
+    def put(self, connection, docid, body):
+        pass
+
+    def delete(self, connection, docid):
+        pass
+
+    def find(self, connection, words, limit, after=None):
+        params = {"limit": limit}
+        where = []
+        for i, word in enumerate(words):
+            where.append("lower(body) LIKE :word%d" % i)
+            params["word%d" % i] = "%" + word + "%"
+        if after is not None:
+            where.append("docid > :docid")
+            params["docid"] = after[1]
+        return connection.execute(
+            db.text(
+                "SELECT docid, 0.0 AS rank FROM ("
+                "SELECT id * 2 AS docid, body FROM posts UNION ALL "
+                "SELECT id * 2 + 1, body FROM comments WHERE disabled IS NOT TRUE"
+                ") documents WHERE "
+                + " AND ".join(where)
+                + " ORDER BY docid LIMIT :limit"
+            ),
+            params,
+        ).all()
+
+    def rebuild(self, connection):
+        pass
+
+
+BACKENDS = {"sqlite": FTS5Backend(), "postgresql": TSVectorBackend()}
+
+
+def backend_for(connection):
+    return BACKENDS.get(connection.dialect.name, ScanBackend())
+
+
+@db.event.listens_for(db.metadata, "after_create")
+def _create_index(target, connection, **kw):
+    for statement in backend_for(connection).create:
+        connection.execute(db.text(statement))
+
+
+@db.event.listens_for(db.metadata, "before_drop")
+def _drop_index(target, connection, **kw):
+    for statement in backend_for(connection).drop:
+        connection.execute(db.text(statement))
+
+
+def index_document(connection, kind, id, body):
+    """Add or replace the indexed body of a post or comment, on the
+    connection flushing it so it commits or rolls back with the row"""
+    backend_for(connection).put(connection, document_id(kind, id), body)
+
+
+def remove_document(connection, kind, id):
+    backend_for(connection).delete(connection, document_id(kind, id))
+
+
+def encode_cursor(hit):
+    """Opaque cursor pointing just past hit in (rank, document id) order"""
+    raw = json.dumps([hit.rank, document_id(hit.kind, hit.id)])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        rank, docid = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(rank), int(docid)
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValidationError("invalid cursor")
+
+
+def find(query, limit, cursor=None):
+    """Best matches of query, best first
+
+    Returns (hits, next_cursor), next_cursor is None on the last page.
+    Pages are seeked past the (rank, document id) of the cursor rather
+    than offset, so every page costs the same.
+    """
+    words = terms(query)
+    if not words:
+        return [], None
+    after = decode_cursor(cursor) if cursor else None
+    connection = db.session.connection()
+    # one extra row tells us whether there is a next page
+    rows = backend_for(connection).find(connection, words, limit + 1, after)
+    hits = [Hit(KINDS[docid % 2], docid // 2, rank) for docid, rank in rows]
+    if len(hits) > limit:
+        hits = hits[:limit]
+        return hits, encode_cursor(hits[-1])
+    return hits, None
+
+
+def load(hits):
+    """(kind, row) of every hit, in order, with the authors eager loaded
+
+    Rows deleted since the hits were found are skipped.
+    """
+    from .models import Comment, Post
+
+    rows = {}
+    for kind, model in (("post", Post), ("comment", Comment)):
+        ids = [hit.id for hit in hits if hit.kind == kind]
+        if ids:
+            query = model.with_author(model.query).filter(model.id.in_(ids))
+            rows.update(((kind, row.id), row) for row in query)
+    return [
+        (hit.kind, rows[hit.kind, hit.id]) for hit in hits if (hit.kind, hit.id) in rows
+    ]
+
+
+def rebuild():
+    """Rebuild the whole index from the posts and comments tables
+
+    Runs in the current transaction, the caller commits.
+    """
+    connection = db.session.connection()
+    backend_for(connection).rebuild(connection)
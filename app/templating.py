@@ -0,0 +1,28 @@
+import os
+
+from jinja2 import FileSystemBytecodeCache
+
+
+def init_templates(app):
+    """Set up the template bytecode cache and, when asked, compile every
+    template now instead of on the first request that renders it
+
+    Must run once the blueprints are registered, so their templates (and
+    the flask_bootstrap ones) are found too.
+    """
+    path = app.config["IBLOG_TEMPLATE_CACHE_PATH"]
+    if path:
+        os.makedirs(path, exist_ok=True)
+        # compiled templates survive restarts and are shared by the workers
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(path)
+    if app.config["IBLOG_PRECOMPILE_TEMPLATES"]:
+        compile_templates(app)
+
+
+def compile_templates(app):
+    """Load every template of the application into the jinja environment
+    (and the bytecode cache, if any), returns their names"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
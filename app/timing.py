@@ -0,0 +1,126 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from flask import (
+    before_render_template,
+    current_app,
+    g,
+    has_request_context,
+    request,
+    template_rendered,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Server-Timing metric names and descriptions, in header order
+METRICS = [
+    ("db", "SQL"),
+    ("tpl", "Templates"),
+    ("md", "Markdown"),
+    ("auth", "Password and token checks"),
+]
+
+
+class RequestTiming:
+    """Per-request breakdown of where the time went
+
+    When IBLOG_SERVER_TIMING is set every response gets a Server-Timing
+    header with the time spent running SQL (and the number of queries),
+    rendering templates, rendering Markdown and checking passwords and
+    tokens, plus the total. The same numbers are logged as one logfmt line
+    per request. The metrics can overlap, e.g. a lazy load done by a
+    template counts for both db and tpl.
+    """
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+
+    def _timings(self):
+        if has_request_context():
+            return g.get("request_timings")
+        return None
+
+    def _start(self):
+        if current_app.config["IBLOG_SERVER_TIMING"]:
+            g.request_timings = {"start": time.perf_counter(), "queries": 0}
+
+    def add(self, name, seconds):
+        timings = self._timings()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def measure(self, name):
+        """Add the time spent in the with block to metric name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def _template_started(self, app, template, context):
+        timings = self._timings()
+        if timings is not None:
+            # templates rendered while rendering another one, like the
+            # post fragments, are part of the outer one's time
+            if timings.get("tpl_depth", 0) == 0:
+                timings["tpl_start"] = time.perf_counter()
+            timings["tpl_depth"] = timings.get("tpl_depth", 0) + 1
+
+    def _template_finished(self, app, template, context):
+        timings = self._timings()
+        if timings is not None and timings.get("tpl_depth"):
+            timings["tpl_depth"] -= 1
+            if timings["tpl_depth"] == 0:
+                self.add("tpl", time.perf_counter() - timings["tpl_start"])
+
+    def _finish(self, response):
+        timings = g.pop("request_timings", None)
+        if timings is None:
+            return response
+        total = time.perf_counter() - timings["start"]
+        entries = []
+        for name, description in METRICS:
+            if name == "db":
+                description = "%d queries" % timings["queries"]
+            entries.append(
+                '%s;dur=%.1f;desc="%s"'
+                % (name, timings.get(name, 0.0) * 1000, description)
+            )
+        entries.append("total;dur=%.1f" % (total * 1000))
+        response.headers.add("Server-Timing", ", ".join(entries))
+        logger.info(
+            "method=%s path=%s status=%d total_ms=%.1f queries=%d %s",
+            request.method,
+            request.path,
+            response.status_code,
+            total * 1000,
+            timings["queries"],
+            " ".join(
+                "%s_ms=%.1f" % (name, timings.get(name, 0.0) * 1000)
+                for name, _ in METRICS
+            ),
+        )
+        return response
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "request_timings" in g:
+        conn.info.setdefault("request_timing_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("request_timing_start")
+    if starts and has_request_context() and "request_timings" in g:
+        g.request_timings["queries"] += 1
+        g.request_timings["db"] = g.request_timings.get("db", 0.0) + (
+            time.perf_counter() - starts.pop()
+        )
@@ -0,0 +1,70 @@
+import logging
+import math
+import sqlite3
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+class TrendingCompactor:
+    """Background thread running PostScore.compact() periodically
+
+    Started by the first request of each worker and run every
+    IBLOG_TRENDING_COMPACT_INTERVAL seconds; with the interval set to 0
+    nothing is started and compaction is left to flask compact-scores.
+    Several workers compacting is harmless, each run recomputes the same
+    scores.
+    """
+
+    def init_app(self, app):
+        app.extensions["trending_compactor"] = {
+            "lock": threading.Lock(),
+            "thread": None,
+            "stopping": threading.Event(),
+        }
+        app.before_request(lambda: self._start(app))
+
+    def _start(self, app):
+        interval = app.config["IBLOG_TRENDING_COMPACT_INTERVAL"]
+        state = app.extensions["trending_compactor"]
+        if not interval or state["thread"] is not None:
+            return
+        with state["lock"]:
+            if state["thread"] is None:
+                state["thread"] = threading.Thread(
+                    target=self._run, args=(app, state, interval), daemon=True
+                )
+                state["thread"].start()
+
+    def _run(self, app, state, interval):
+        while not state["stopping"].wait(interval):
+            try:
+                self.compact(app)
+            except Exception:
+                # the next run gets another chance
+                logger.exception("trending compaction failed")
+
+    def compact(self, app):
+        """Recompute the scores of app, returns the number of scored posts"""
+        from . import db
+        from .models import PostScore
+
+        with app.app_context():
+            try:
+                count = PostScore.compact()
+                db.session.commit()
+            finally:
+                db.session.remove()
+        return count
+
+
+@event.listens_for(Engine, "connect")
+def _add_math_functions(dbapi_connection, connection_record):
+    # PostScore.bump() needs ln() and exp(), which SQLite only has when
+    # compiled with its math functions
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function("ln", 1, math.log, deterministic=True)
+        dbapi_connection.create_function("exp", 1, math.exp, deterministic=True)
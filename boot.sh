@@ -10,6 +10,11 @@ while true; do
     sleep 5
 done
 
+# fill the template bytecode cache, workers then compile every template
+# from it at boot instead of on their first requests
+flask compile-templates
+export IBLOG_PRECOMPILE_TEMPLATES=1
+
 # --access-logfile -: log http requests to stdout, `-` meaning
 # make gunicorn process take over the process running the boot.sh
 # because when the process ends the container ends as well so docker
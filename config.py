@@ -19,15 +19,115 @@ class Config:
     MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
     IBLOG_MAIL_SUBJECT_PREFIX = "[IBlog]"
     IBLOG_MAIL_SENDER = "IBlog Admin <admin@iblog.com>"
+    # background senders per worker process, 0 sends in the request
+    IBLOG_MAIL_WORKERS = int(os.environ.get("IBLOG_MAIL_WORKERS", 2))
+    IBLOG_MAIL_QUEUE_SIZE = int(os.environ.get("IBLOG_MAIL_QUEUE_SIZE", 1000))
+    # seconds send_email waits for room in a full queue before dropping
+    IBLOG_MAIL_QUEUE_TIMEOUT = float(os.environ.get("IBLOG_MAIL_QUEUE_TIMEOUT", 5))
+    # messages sent over a single SMTP session
+    IBLOG_MAIL_BATCH_SIZE = int(os.environ.get("IBLOG_MAIL_BATCH_SIZE", 50))
+    IBLOG_MAIL_RETRIES = int(os.environ.get("IBLOG_MAIL_RETRIES", 3))
+    IBLOG_MAIL_RETRY_BACKOFF = float(os.environ.get("IBLOG_MAIL_RETRY_BACKOFF", 1))
+    # how long an exiting process keeps sending what is queued
+    IBLOG_MAIL_DRAIN_TIMEOUT = float(os.environ.get("IBLOG_MAIL_DRAIN_TIMEOUT", 10))
     IBLOG_ADMIN = os.environ.get("IBLOG_ADMIN")
     IBLOG_POSTS_PER_PAGE = int(os.environ.get("IBLOG_POSTS_PER_PAGE", 10))
     IBLOG_FOLLOWERS_PER_PAGE = int(os.environ.get("IBLOG_FOLLOWERS_PER_PAGE", 10))
     IBLOG_COMMENTS_PER_PAGE = int(os.environ.get("IBLOG_COMMENTS_PER_PAGE", 10))
+    # authors with more followers than this aren't copied into timelines
+    # when they post, their posts are merged in when a timeline is read
+    IBLOG_TIMELINE_FANOUT_LIMIT = int(
+        os.environ.get("IBLOG_TIMELINE_FANOUT_LIMIT", 1000)
+    )
+    # comments on a post count half as much toward trending every
+    # IBLOG_TRENDING_HALF_LIFE hours, compaction forgets what happened more
+    # than IBLOG_TRENDING_WINDOW hours ago every
+    # IBLOG_TRENDING_COMPACT_INTERVAL seconds (0 leaves it to
+    # flask compact-scores)
+    IBLOG_TRENDING_HALF_LIFE = float(os.environ.get("IBLOG_TRENDING_HALF_LIFE", 24))
+    IBLOG_TRENDING_WINDOW = float(os.environ.get("IBLOG_TRENDING_WINDOW", 168))
+    IBLOG_TRENDING_COMPACT_INTERVAL = int(
+        os.environ.get("IBLOG_TRENDING_COMPACT_INTERVAL", 600)
+    )
+    # upper bound for the ?limit= of cursor paginated API collections
+    IBLOG_API_MAX_PAGE_SIZE = int(os.environ.get("IBLOG_API_MAX_PAGE_SIZE", 100))
+    # upper bound for the number of requests sent to /api/v1/batch at once
+    IBLOG_API_MAX_BATCH_SIZE = int(os.environ.get("IBLOG_API_MAX_BATCH_SIZE", 20))
 
     # For measuring db performance
     # enable recording of the query statistics
     SQLALCHEMY_RECORD_QUERIES = True
     IBLOG_SLOW_DB_QUERY_TIME = float(os.environ.get("IBLOG_SLOW_DB_QUERY_TIME", 0.5))
+    # number of query fingerprints each worker keeps statistics for
+    IBLOG_QUERY_STATS_SIZE = int(os.environ.get("IBLOG_QUERY_STATS_SIZE", 1000))
+    # where profiles of sampled requests are written, how often their
+    # stack is sampled and the X-Profile header value that always
+    # profiles a request (unset disables the header)
+    IBLOG_PROFILER_DIR = os.environ.get(
+        "IBLOG_PROFILER_DIR", os.path.join(basedir, "tmp", "profiles")
+    )
+    IBLOG_PROFILER_INTERVAL = float(os.environ.get("IBLOG_PROFILER_INTERVAL", 0.005))
+    IBLOG_PROFILER_TOKEN = os.environ.get("IBLOG_PROFILER_TOKEN")
+    # add a Server-Timing header and a timing log line to every response
+    IBLOG_SERVER_TIMING = os.environ.get("IBLOG_SERVER_TIMING", "false").lower() in [
+        "true",
+        "on",
+        "1",
+    ]
+    # last_seen is only rewritten when it is older than this many seconds
+    IBLOG_LAST_SEEN_RESOLUTION = int(os.environ.get("IBLOG_LAST_SEEN_RESOLUTION", 60))
+    # buffered last_seen updates are written out at most this often
+    IBLOG_LAST_SEEN_FLUSH_INTERVAL = int(
+        os.environ.get("IBLOG_LAST_SEEN_FLUSH_INTERVAL", 30)
+    )
+    # how many logged in users are cached per worker and for how long,
+    # other workers see profile and role changes only after the ttl
+    IBLOG_USER_CACHE_SIZE = int(os.environ.get("IBLOG_USER_CACHE_SIZE", 1024))
+    IBLOG_USER_CACHE_TTL = int(os.environ.get("IBLOG_USER_CACHE_TTL", 30))
+    # number of rendered Markdown bodies kept per worker
+    IBLOG_RENDER_CACHE_SIZE = int(os.environ.get("IBLOG_RENDER_CACHE_SIZE", 2048))
+    # how long a verified API email and password pair skips the password
+    # hash check, a password change invalidates it right away
+    IBLOG_CREDENTIAL_CACHE_SIZE = int(
+        os.environ.get("IBLOG_CREDENTIAL_CACHE_SIZE", 1024)
+    )
+    IBLOG_CREDENTIAL_CACHE_TTL = int(os.environ.get("IBLOG_CREDENTIAL_CACHE_TTL", 60))
+    # issue API tokens that carry the user's confirmed flag and permissions,
+    # revoked tokens keep working in other workers for up to the ttl
+    IBLOG_STATELESS_TOKENS = os.environ.get(
+        "IBLOG_STATELESS_TOKENS", "false"
+    ).lower() in ["true", "on", "1"]
+    IBLOG_TOKEN_GENERATION_CACHE_SIZE = int(
+        os.environ.get("IBLOG_TOKEN_GENERATION_CACHE_SIZE", 4096)
+    )
+    IBLOG_TOKEN_GENERATION_CACHE_TTL = int(
+        os.environ.get("IBLOG_TOKEN_GENERATION_CACHE_TTL", 30)
+    )
+    # number of rendered post and comment <li> fragments kept per worker,
+    # keyed by row version and body; the ttl bounds how long anything
+    # else they show can be stale
+    IBLOG_FRAGMENT_CACHE_SIZE = int(os.environ.get("IBLOG_FRAGMENT_CACHE_SIZE", 4096))
+    IBLOG_FRAGMENT_CACHE_TTL = int(os.environ.get("IBLOG_FRAGMENT_CACHE_TTL", 3600))
+    # cache of the pages anonymous users get: "lru" keeps them in each
+    # worker, "sqlite" shares them between the workers of a host through
+    # the file at IBLOG_PAGE_CACHE_PATH and "" turns the cache off
+    IBLOG_PAGE_CACHE = os.environ.get("IBLOG_PAGE_CACHE", "lru")
+    IBLOG_PAGE_CACHE_PATH = os.environ.get(
+        "IBLOG_PAGE_CACHE_PATH", os.path.join(basedir, "tmp", "page-cache.sqlite")
+    )
+    IBLOG_PAGE_CACHE_SIZE = int(os.environ.get("IBLOG_PAGE_CACHE_SIZE", 512))
+    # also bounds how stale the last_seen shown on profiles can get
+    IBLOG_PAGE_CACHE_TTL = int(os.environ.get("IBLOG_PAGE_CACHE_TTL", 60))
+    # fail views decorated with no_lazy_loads when they lazy load
+    IBLOG_RAISE_ON_LAZY_LOAD = False
+    # directory keeping compiled templates between restarts, "" disables it
+    IBLOG_TEMPLATE_CACHE_PATH = os.environ.get(
+        "IBLOG_TEMPLATE_CACHE_PATH", os.path.join(basedir, "tmp", "jinja-cache")
+    )
+    # compile every template when the application is created
+    IBLOG_PRECOMPILE_TEMPLATES = os.environ.get(
+        "IBLOG_PRECOMPILE_TEMPLATES", "false"
+    ).lower() in ["true", "on", "1"]
 
     @staticmethod
     def init_app(app):
@@ -44,6 +144,14 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     WTF_CSRF_ENABLED = False
+    IBLOG_RAISE_ON_LAZY_LOAD = True
+    # write last_seen through on every ping
+    IBLOG_LAST_SEEN_RESOLUTION = 0
+    IBLOG_LAST_SEEN_FLUSH_INTERVAL = 0
+    IBLOG_TEMPLATE_CACHE_PATH = ""
+    # mail is sent (or recorded) before the request returns
+    IBLOG_MAIL_WORKERS = 0
+    IBLOG_TRENDING_COMPACT_INTERVAL = 0
     SQLALCHEMY_DATABASE_URI = os.environ.get(
         "TEST_DATABASE_URL"
     ) or "sqlite:///" + os.path.join(basedir, "data-test.sqlite")
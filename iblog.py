@@ -1,8 +1,8 @@
 import os
 import sys
 import click
-from app import create_app, db
-from app.models import User, Role, Post
+from app import create_app, db, search
+from app.models import User, Role, Post, PostScore, Comment, TimelineEntry
 from flask_migrate import Migrate, upgrade
 from flask_login import login_required
 from dotenv import load_dotenv
@@ -43,15 +43,128 @@ def make_shell_context():
 @app.cli.command()
 def deploy():
     """Run deployment tasks"""
+    import time
+
+    def step(name, task):
+        start = time.perf_counter()
+        task()
+        click.echo(f"{name}: {time.perf_counter() - start:.2f}s")
+
     # migrate database to latest revision
-    db.create_all()
-    upgrade()
+    step("create tables", db.create_all)
+    step("upgrade", upgrade)
 
     # create or update user roles
-    Role.insert_roles()
+    step("insert roles", Role.insert_roles)
 
     # ensure all users are following themselves
-    User.add_self_follows()
+    step("add self follows", User.add_self_follows)
+
+
+@app.cli.command()
+def recount():
+    """Rebuild the denormalized post, comment and follow counters"""
+    User.recount()
+    Post.recount()
+    db.session.commit()
+
+
+@app.cli.command("rebuild-timeline")
+def rebuild_timeline():
+    """Regenerate the materialized followed posts timelines"""
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+
+@app.cli.command("compact-scores")
+def compact_scores():
+    """Recompute the trending post scores, for running from cron"""
+    click.echo(f"{PostScore.compact()} posts scored")
+    db.session.commit()
+
+
+@app.cli.command()
+def reindex():
+    """Rebuild the full-text search index of posts and comments"""
+    import time
+
+    start = time.perf_counter()
+    search.rebuild()
+    db.session.commit()
+    click.echo(f"reindexed in {time.perf_counter() - start:.2f}s")
+
+
+@app.cli.command()
+@click.option("--posts", is_flag=True, help="Re-render post bodies.")
+@click.option("--comments", is_flag=True, help="Re-render comment bodies.")
+@click.option(
+    "--workers",
+    default=os.cpu_count() or 1,
+    help="Number of processes rendering Markdown.",
+)
+@click.option("--batch-size", default=500, help="Rows read and written at once.")
+@click.option(
+    "--after-id",
+    default=0,
+    help="Resume the first table after this id, as printed by an " "interrupted run.",
+)
+def rerender(posts, comments, workers, batch_size, after_id):
+    """Regenerate body_html, e.g. after changing the allowed tags.
+    Re-renders both posts and comments unless one of them is picked,
+    --after-id then applies to the posts and the comments start over."""
+    from app.rendering import rerender as rerender_bodies
+
+    if not posts and not comments:
+        posts = comments = True
+    for enabled, model, profile in [
+        (posts, Post, "post"),
+        (comments, Comment, "comment"),
+    ]:
+        if not enabled:
+            continue
+
+        def progress(done, last_id):
+            click.echo(f"{model.__tablename__}: {done} rows done, last id {last_id}")
+
+        changed = rerender_bodies(
+            model, profile, workers, batch_size, after_id, progress
+        )
+        click.echo(f"{model.__tablename__}: {changed} rows updated")
+        # the ids printed by an interrupted run are those of one table only
+        after_id = 0
+
+
+@app.cli.command()
+@click.option("--users", default=0, help="Number of users to add.")
+@click.option("--posts", default=0, help="Number of posts to add.")
+@click.option("--comments", default=0, help="Number of comments to add.")
+@click.option("--follows", default=0, help="Number of follows to add.")
+@click.option("--seed", default=0, help="Random seed, same seed same data.")
+@click.option("--batch-size", default=5000, help="Rows inserted at once.")
+def fake(users, posts, comments, follows, seed, batch_size):
+    """Add fake users, posts, comments and follows in bulk."""
+    import time
+    from app.fake import bulk
+
+    done = {}
+    start = time.perf_counter()
+
+    def progress(table, rows):
+        done[table] = done.get(table, 0) + rows
+        elapsed = time.perf_counter() - start
+        click.echo(f"{table}: {done[table]} rows, {elapsed:.1f}s")
+
+    bulk(users, posts, comments, follows, seed, batch_size, progress)
+    click.echo(f"done in {time.perf_counter() - start:.1f}s")
+
+
+@app.cli.command("compile-templates")
+def compile_templates():
+    """Compile every template into the bytecode cache"""
+    from app.templating import compile_templates
+
+    names = compile_templates(app)
+    click.echo(f"{len(names)} templates compiled")
 
 
 @app.cli.command()
@@ -80,6 +193,53 @@ def test(coverage):
         COV.erase()
 
 
+@app.cli.command()
+@click.option(
+    "--scale",
+    default="small",
+    type=click.Choice(["small", "medium", "large"]),
+    help="Size of the generated dataset.",
+)
+@click.option("--seed", default=0, help="Seed of the generated dataset.")
+@click.option("--requests", default=50, help="Timed requests per endpoint.")
+@click.option("--output", default=None, help="JSON file the results are written to.")
+@click.option(
+    "--compare", default=None, help="JSON file of an earlier run to compare with."
+)
+def bench(scale, seed, requests, output, compare):
+    """Benchmark the endpoints on a generated dataset."""
+    import json
+    from app.bench import compare as compare_results, run, save
+
+    def progress(name, result):
+        click.echo(
+            f"{name:32} p50 {result['p50_ms']:8.2f} ms  "
+            f"p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms  "
+            f"{result['queries']:5.1f} queries  "
+            f"{result['peak_alloc_kib']:8.1f} KiB"
+        )
+
+    old = None
+    if compare:
+        # read first, the new results may be written over it
+        with open(compare) as f:
+            old = json.load(f)
+    results = run(
+        os.getenv("FLASK_CONFIG", "default"), scale, seed, requests, progress=progress
+    )
+    output = output or os.path.join(
+        "tmp", "bench", f"{scale}-{seed}-{results['revision'] or 'results'}.json"
+    )
+    save(results, output)
+    click.echo(f"results written to {output}")
+    if old is not None:
+        for name, metric, before, after in compare_results(old, results):
+            change = (after - before) / before * 100 if before else 0.0
+            click.echo(
+                f"{name:32} {metric:14} {before:10.2f} {after:10.2f} {change:+7.1f}%"
+            )
+
+
 @app.cli.command()
 @click.option(
     "--length",
@@ -2,7 +2,9 @@ import unittest
 import json
 import re
 from base64 import b64encode
+from unittest import mock
 from app import create_app, db
+from app.rendering import rerender
 from app.models import User, Role, Post, Comment
 from flask import url_for
 
@@ -299,3 +301,462 @@ class APITestCase(unittest.TestCase):
         json_response = json.loads(response.get_data(as_text=True))
         self.assertIsNotNone(json_response.get("comments"))
         self.assertEqual(json_response.get("count", 0), 2)
+
+    def test_cursor_pagination(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="joe@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        for i in range(5):
+            db.session.add(Post(body="post %d" % i, author=u))
+        db.session.commit()
+
+        # walk every page following the next cursors
+        bodies = []
+        url = "/api/v1/posts/?cursor=&limit=2"
+        while url:
+            response = self.client.get(
+                url, headers=self.get_api_headers("joe@example.com", "cat")
+            )
+            self.assertEqual(response.status_code, 200)
+            json_response = json.loads(response.get_data(as_text=True))
+            self.assertNotIn("count", json_response)
+            self.assertLessEqual(len(json_response["posts"]), 2)
+            bodies += [post["body"] for post in json_response["posts"]]
+            url = json_response["next_url"]
+        self.assertEqual(bodies, ["post %d" % i for i in reversed(range(5))])
+
+        # count is only computed on request
+        response = self.client.get(
+            "/api/v1/users/{}/posts/?cursor=&with_count=1".format(u.id),
+            headers=self.get_api_headers("joe@example.com", "cat"),
+        )
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response["count"], 5)
+
+        # a tampered cursor is a client error
+        response = self.client.get(
+            "/api/v1/posts/?cursor=garbage",
+            headers=self.get_api_headers("joe@example.com", "cat"),
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_search(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="joe@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        posts = [Post(body="gardening tips %d" % i, author=u) for i in range(3)]
+        posts.append(Post(body="cooking", author=u))
+        db.session.add_all(posts)
+        db.session.commit()
+        comment = Comment(body="more gardening please", post=posts[3], author=u)
+        db.session.add(comment)
+        db.session.commit()
+
+        def search(url):
+            response = self.client.get(
+                url, headers=self.get_api_headers("joe@example.com", "cat")
+            )
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.get_data(as_text=True))
+
+        # walk every page following the next cursors
+        found = []
+        url = "/api/v1/search/?q=Gardening&limit=2"
+        while url:
+            json_response = search(url)
+            self.assertLessEqual(len(json_response["results"]), 2)
+            found += [
+                (result["type"], result[result["type"]]["body"])
+                for result in json_response["results"]
+            ]
+            url = json_response["next"]
+        self.assertEqual(len(found), 4)
+        self.assertIn(("comment", "more gardening please"), found)
+
+        # edits, moderation and deletes are reflected immediately
+        posts[0].body = "knitting"
+        comment.disabled = True
+        db.session.delete(posts[1])
+        db.session.commit()
+        json_response = search("/api/v1/search/?q=gardening")
+        self.assertEqual(
+            [result["post"]["body"] for result in json_response["results"]],
+            ["gardening tips 2"],
+        )
+        json_response = search("/api/v1/search/?q=knitting")
+        self.assertEqual(len(json_response["results"]), 1)
+
+        # FTS operators are searched for as words
+        json_response = search('/api/v1/search/?q=" OR NEAR(')
+        self.assertEqual(json_response["results"], [])
+
+        # a tampered cursor is a client error
+        response = self.client.get(
+            "/api/v1/search/?q=gardening&cursor=garbage",
+            headers=self.get_api_headers("joe@example.com", "cat"),
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_ids(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="joe@example.com", password="cat", confirmed=True, role=r)
+        posts = [Post(body="post %d" % i, author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        headers = self.get_api_headers("joe@example.com", "cat")
+
+        # in the order asked for, missing ids are skipped
+        ids = "{},{},999,{}".format(posts[2].id, posts[0].id, posts[2].id)
+        response = self.client.get("/api/v1/posts/?ids=" + ids, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(
+            [post["body"] for post in json_response["posts"]], ["post 2", "post 0"]
+        )
+
+        response = self.client.get(
+            "/api/v1/users/?ids={}".format(u.id), headers=headers
+        )
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(
+            [user["url"] for user in json_response["users"]],
+            ["/api/v1/users/{}".format(u.id)],
+        )
+
+        for url in ["/api/v1/users/", "/api/v1/posts/?ids=1,x"]:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+    def test_batch(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="joe@example.com", password="cat", confirmed=True, role=r)
+        posts = [Post(body="post %d" % i, author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        requests = [{"path": "/api/v1/posts/{}".format(post.id)} for post in posts] + [
+            {"path": "/api/v1/users/{}".format(u.id)},
+            {
+                "method": "POST",
+                "path": "/api/v1/posts/{}/comments/".format(posts[0].id),
+                "body": {"body": "batched"},
+            },
+            {"path": "/api/v1/posts/{}/comments/".format(posts[0].id)},
+            {"path": "/api/v1/posts/999"},
+            {"path": "/api/v1/batch", "method": "POST"},
+            {"path": "/auth/login"},
+        ]
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        with mock.patch.object(
+            User, "verify_password", autospec=True, return_value=True
+        ) as verify_password:
+            response = self.client.post(
+                "/api/v1/batch",
+                headers=self.get_api_headers("joe@example.com", "cat"),
+                data=json.dumps({"requests": requests}),
+            )
+        db.event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(verify_password.call_count, 1)
+        responses = json.loads(response.get_data(as_text=True))["responses"]
+        self.assertEqual(
+            [sub["status"] for sub in responses],
+            [200, 200, 200, 200, 201, 200, 404, 404, 404],
+        )
+        self.assertEqual(
+            [sub["body"]["body"] for sub in responses[:3]],
+            ["post 0", "post 1", "post 2"],
+        )
+        self.assertIn("ETag", responses[0]["headers"])
+        self.assertEqual(responses[4]["body"]["body"], "batched")
+        self.assertEqual(responses[5]["body"]["comments"][0]["body"], "batched")
+        # the posts were loaded together, not one query per sub-request
+        post_lookups = [
+            s for s in statements if s.startswith("SELECT posts.") and " IN " in s
+        ]
+        self.assertEqual(len(post_lookups), 1)
+        # only the missing post and the one expired by the POST's commit
+        # are looked up on their own
+        self.assertEqual(
+            len(
+                [s for s in statements if s.endswith("FROM posts \nWHERE posts.id = ?")]
+            ),
+            2,
+        )
+
+        response = self.client.post(
+            "/api/v1/batch",
+            headers=self.get_api_headers("joe@example.com", "cat"),
+            data=json.dumps({"requests": [{"path": "/"}] * 21}),
+        )
+        self.assertEqual(response.status_code, 400)
+
+        post_url = "/api/v1/posts/{}".format(posts[1].id)
+
+        # malformed batches are client errors
+        for body in [
+            [{"path": "/api/v1/posts/"}],
+            {"requests": [{"path": "/api/v1/posts/", "headers": "x"}]},
+            {"requests": [{"path": "/api/v1/posts/", "method": 5}]},
+        ]:
+            response = self.client.post(
+                "/api/v1/batch",
+                headers=self.get_api_headers("joe@example.com", "cat"),
+                data=json.dumps(body),
+            )
+            self.assertEqual(response.status_code, 400)
+
+        # a failing sub-request only fails its own entry
+        comment_url = "/api/v1/posts/{}/comments/".format(posts[1].id)
+        with mock.patch.object(Comment, "from_json", side_effect=RuntimeError):
+            response = self.client.post(
+                "/api/v1/batch",
+                headers=self.get_api_headers("joe@example.com", "cat"),
+                data=json.dumps(
+                    {
+                        "requests": [
+                            {"method": "PUT", "path": post_url, "body": {"body": "x"}},
+                            {"method": "POST", "path": comment_url, "body": {}},
+                            {"path": post_url},
+                        ]
+                    }
+                ),
+            )
+        self.assertEqual(response.status_code, 200)
+        responses = json.loads(response.get_data(as_text=True))["responses"]
+        self.assertEqual([sub["status"] for sub in responses], [200, 500, 200])
+        self.assertEqual(responses[2]["body"]["body"], "x")
+
+    def test_fields_and_expand(self):
+        r = Role.query.filter_by(name="User").first()
+        u1 = User(
+            email="joe@example.com",
+            username="joe",
+            password="cat",
+            confirmed=True,
+            role=r,
+        )
+        u2 = User(email="sam@example.com", username="sam", password="dog", role=r)
+        posts = [Post(body="post %d" % i, author=u) for i, u in enumerate([u1, u2])]
+        db.session.add_all([u1, u2] + posts)
+        for i in range(12):
+            db.session.add(Comment(body="comment %d" % i, post=posts[0], author=u2))
+        db.session.commit()
+        headers = self.get_api_headers("joe@example.com", "cat")
+
+        def get(url):
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            return response, json.loads(response.get_data(as_text=True))
+
+        # only the fields asked for
+        _, json_response = get("/api/v1/posts/{}?fields=body".format(posts[0].id))
+        self.assertEqual(json_response, {"body": "post 0"})
+        _, json_response = get("/api/v1/users/{}?fields=username".format(u1.id))
+        self.assertEqual(json_response, {"username": "joe"})
+        # an expansion named in the fields is expanded
+        _, json_response = get("/api/v1/posts/{}?fields=author".format(posts[1].id))
+        self.assertEqual(list(json_response), ["author"])
+        self.assertEqual(json_response["author"]["username"], "sam")
+
+        # authors and the first page of comments, with one query each
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.session.expunge_all()
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        full, json_response = get("/api/v1/posts/?expand=author&fields=body,comments")
+        db.event.remove(db.engine, "before_cursor_execute", record)
+        by_body = {post["body"]: post for post in json_response["posts"]}
+        self.assertEqual(by_body["post 0"]["author"]["username"], "joe")
+        self.assertEqual(by_body["post 1"]["author"]["username"], "sam")
+        self.assertEqual(
+            [comment["body"] for comment in by_body["post 0"]["comments"]],
+            ["comment %d" % i for i in range(10)],
+        )
+        self.assertEqual(by_body["post 1"]["comments"], [])
+        self.assertEqual(
+            len([s for s in statements if "FROM comments" in s and "row_number" in s]),
+            1,
+        )
+        self.assertFalse([s for s in statements if s.endswith("WHERE users.id = ?")])
+
+        # every shape has its own ETag
+        plain, _ = get("/api/v1/posts/")
+        self.assertNotEqual(full.headers["ETag"], plain.headers["ETag"])
+
+        for url in ["/api/v1/posts/?fields=nope", "/api/v1/users/1?expand=author"]:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 400)
+
+    def test_conditional_get(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="joe@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        post = Post(body="body", author=u)
+        db.session.add(post)
+        db.session.commit()
+        headers = self.get_api_headers("joe@example.com", "cat")
+
+        def get(url, etag=None):
+            extra = {"If-None-Match": etag} if etag else {}
+            return self.client.get(url, headers=dict(headers, **extra))
+
+        for url in (
+            "/api/v1/posts/{}".format(post.id),
+            "/api/v1/posts/",
+            "/api/v1/users/{}/posts/?cursor=".format(u.id),
+        ):
+            response = get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers["ETag"]
+            # an unchanged resource is not sent again
+            response = get(url, etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b"")
+            self.assertEqual(response.headers["ETag"], etag)
+
+        # editing the post changes its etag and the etags of the lists
+        url = "/api/v1/posts/{}".format(post.id)
+        etag = get(url).headers["ETag"]
+        list_etag = get("/api/v1/posts/").headers["ETag"]
+        response = self.client.put(
+            url, headers=headers, data=json.dumps({"body": "updated body"})
+        )
+        self.assertEqual(response.status_code, 200)
+        response = get(url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(get("/api/v1/posts/", list_etag).status_code, 200)
+
+        # so does a new comment, through the comment counter
+        etag = get(url).headers["ETag"]
+        db.session.add(Comment(body="comment", author=u, post=post))
+        db.session.commit()
+        self.assertEqual(get(url, etag).status_code, 200)
+
+    def test_etag_changes_after_rerender(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="joe@example.com", password="cat", confirmed=True, role=r)
+        post = Post(body="*emphasis*", author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        headers = self.get_api_headers("joe@example.com", "cat")
+        url = "/api/v1/posts/{}".format(post.id)
+        etag = self.client.get(url, headers=headers).headers["ETag"]
+
+        # html rendered by an older pipeline is rewritten by rerender()
+        db.session.execute(Post.__table__.update().values(body_html="stale"))
+        db.session.commit()
+        self.assertEqual(rerender(Post, "post"), 1)
+        db.session.expire_all()
+        response = self.client.get(
+            url, headers=dict(headers, **{"If-None-Match": etag})
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertIn("<em>", json.loads(response.get_data(as_text=True))["body_html"])
+
+    def test_credential_cache(self):
+        self.app.config["SECRET_KEY"] = "secret"
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="joe@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+
+        import app.models
+
+        with mock.patch.object(
+            app.models,
+            "check_password_hash",
+            wraps=app.models.check_password_hash,
+        ) as check_password_hash:
+            for _ in range(3):
+                response = self.client.get(
+                    "/api/v1/posts/",
+                    headers=self.get_api_headers("joe@example.com", "cat"),
+                )
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(check_password_hash.call_count, 1)
+
+            # a wrong password is always checked
+            response = self.client.get(
+                "/api/v1/posts/", headers=self.get_api_headers("joe@example.com", "dog")
+            )
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(check_password_hash.call_count, 2)
+
+            # nothing is cached without a secret to key it
+            self.app.config["SECRET_KEY"] = None
+            for _ in range(2):
+                response = self.client.get(
+                    "/api/v1/posts/",
+                    headers=self.get_api_headers("joe@example.com", "cat"),
+                )
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(check_password_hash.call_count, 4)
+
+        # the cached credentials die with the password
+        u.password = "dog"
+        db.session.commit()
+        response = self.client.get(
+            "/api/v1/posts/", headers=self.get_api_headers("joe@example.com", "cat")
+        )
+        self.assertEqual(response.status_code, 401)
+
+    def test_stateless_token_auth(self):
+        self.app.config["IBLOG_STATELESS_TOKENS"] = True
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="joe@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        response = self.client.post(
+            "/api/v1/tokens/", headers=self.get_api_headers("joe@example.com", "cat")
+        )
+        token = json.loads(response.get_data(as_text=True))["token"]
+
+        # authorizing the request doesn't touch the users table once the
+        # token generation is cached
+        self.assertEqual(
+            self.client.get(
+                "/api/v1/posts/", headers=self.get_api_headers(token, "")
+            ).status_code,
+            200,
+        )
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.session.expunge_all()
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            response = self.client.post(
+                "/api/v1/posts/",
+                headers=self.get_api_headers(token, ""),
+                data=json.dumps({"body": "body of the *blog* post"}),
+            )
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(
+            any(statement.startswith("SELECT users.") for statement in statements)
+        )
+
+        # bumping the generation revokes the token
+        u = User.query.filter_by(email="joe@example.com").first()
+        u.revoke_auth_tokens()
+        db.session.commit()
+        response = self.client.get(
+            "/api/v1/posts/", headers=self.get_api_headers(token, "")
+        )
+        self.assertEqual(response.status_code, 401)
@@ -1,6 +1,9 @@
+import os
+import tempfile
 import unittest
 from flask import current_app
-from app import create_app, db
+from app import bench, create_app, db
+from app.templating import compile_templates, init_templates
 
 
 class BasicsTestCase(unittest.TestCase):
@@ -26,3 +29,30 @@ class BasicsTestCase(unittest.TestCase):
     def test_app_is_testing(self):
         """Ensure application is running under the testing configuration"""
         self.assertTrue(current_app.config["TESTING"])
+
+    def test_compile_templates(self):
+        """Ensure every template compiles into the bytecode cache"""
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.config["IBLOG_TEMPLATE_CACHE_PATH"] = tmp
+            init_templates(self.app)
+            names = compile_templates(self.app)
+            self.assertIn("_posts.html", names)
+            self.assertIn("bootstrap/base.html", names)
+            self.assertEqual(len(os.listdir(tmp)), len(names))
+
+    def test_bench(self):
+        """Ensure every benchmarked endpoint runs on a generated dataset"""
+        with tempfile.TemporaryDirectory() as tmp:
+            results = bench.run("testing", requests=2, warmup=0, directory=tmp)
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(tmp, "small-0-v%d.sqlite" % bench.DATASET_VERSION)
+                )
+            )
+        self.assertEqual(
+            set(results["endpoints"]),
+            {name for name, _, _, _ in bench.endpoints(results["sample"])},
+        )
+        for metrics in results["endpoints"].values():
+            self.assertLessEqual(metrics["p50_ms"], metrics["p99_ms"])
+            self.assertGreater(metrics["queries"], 0)
@@ -1,7 +1,24 @@
+import json
+import os
+import tempfile
 import unittest
 import re
-from app import create_app, db
-from app.models import User, Role
+import sqlite3
+from unittest import mock
+from flask import render_template
+from app import (
+    create_app,
+    db,
+    fragment_cache,
+    last_seen_buffer,
+    page_cache,
+    query_stats,
+    search,
+)
+from app.decorators import no_lazy_loads
+from app.exceptions import LazyLoadError
+from app.models import User, Role, Post, Comment
+from app.query_stats import fingerprint
 
 
 class FlaskClientTestCase(unittest.TestCase):
@@ -76,3 +93,321 @@ class FlaskClientTestCase(unittest.TestCase):
         response = self.client.get("/auth/logout", follow_redirects=True)
         self.assertEqual(response.status_code, 200)
         self.assertTrue("You have been logged out" in response.get_data(as_text=True))
+
+    def test_last_seen_flush_failure(self):
+        u = User(
+            email="joe@example.com", username="joe", password="cat", confirmed=True
+        )
+        db.session.add(u)
+        db.session.commit()
+        self.client.post(
+            "/auth/login", data={"email": "joe@example.com", "password": "cat"}
+        )
+
+        def lock(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("UPDATE users SET last_seen"):
+                raise sqlite3.OperationalError("database is locked")
+
+        # the page is served and the time stays buffered for the next flush
+        db.event.listen(db.engine, "before_cursor_execute", lock)
+        try:
+            response = self.client.get("/")
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", lock)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(last_seen_buffer.pending(), 1)
+        self.assertEqual(last_seen_buffer.flush(), 1)
+        self.assertEqual(last_seen_buffer.pending(), 0)
+
+    def test_list_views_eager_load(self):
+        # the testing config fails views that lazy load per row
+        moderator = Role.query.filter_by(name="Moderator").first()
+        u1 = User(
+            email="joe@example.com",
+            username="joe",
+            password="cat",
+            confirmed=True,
+            role=moderator,
+        )
+        u2 = User(email="sam@example.com", username="sam", password="dog")
+        post = Post(body="first", author=u1)
+        db.session.add_all([u1, u2, post, Post(body="second", author=u2)])
+        db.session.add(Comment(body="comment", author=u2, post=post))
+        db.session.commit()
+        post_url = "/posts/{}".format(post.id)
+        # start every request with an empty identity map
+        db.session.expunge_all()
+
+        for url in ["/", "/user/joe", post_url]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        self.client.post(
+            "/auth/login", data={"email": "joe@example.com", "password": "cat"}
+        )
+        # the logged in user outlives the requests of the test client as
+        # they share the test's app context, keep only that one
+        joe = User.query.filter_by(email="joe@example.com").first()
+        for obj in list(db.session):
+            if obj is not joe:
+                db.session.expunge(obj)
+        for url in ["/", post_url, "/moderate"]:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+        # the trending tab ranks the commented post first
+        self.client.get("/trending")
+        response = self.client.get("/")
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        self.assertLess(data.index("<p>first</p>"), data.index("<p>second</p>"))
+
+    def test_lazy_load_guard(self):
+        @self.app.route("/lazy")
+        @no_lazy_loads
+        def lazy():
+            return ",".join(post.author.username for post in Post.query.all())
+
+        u = User(email="joe@example.com", username="joe", password="cat")
+        db.session.add_all([u, Post(body="body", author=u)])
+        db.session.commit()
+        db.session.expunge_all()
+        with self.assertRaises(LazyLoadError):
+            self.client.get("/lazy")
+
+    def check_page_cache(self):
+        u = User(
+            email="joe@example.com", username="joe", password="cat", confirmed=True
+        )
+        post = Post(body="original", author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        post_url = "/posts/{}".format(post.id)
+        self.assertIn("original", self.client.get("/").get_data(as_text=True))
+        self.assertIn("original", self.client.get(post_url).get_data(as_text=True))
+
+        # writes that bypass the ORM are not seen until invalidation
+        db.session.execute(Post.__table__.update().values(body_html="changed"))
+        db.session.commit()
+        self.assertIn("original", self.client.get("/").get_data(as_text=True))
+
+        # a new comment invalidates the pages showing its post
+        db.session.add(Comment(body="comment", author=u, post=post))
+        db.session.commit()
+        self.assertIn("changed", self.client.get("/").get_data(as_text=True))
+        self.assertIn("changed", self.client.get(post_url).get_data(as_text=True))
+
+        # a page whose rows change while it renders is not served again
+        def render_and_change(*args, **kwargs):
+            with db.engine.begin() as connection:
+                connection.execute(Post.__table__.update().values(body_html="raced"))
+            page_cache.invalidate("posts")
+            return render_template(*args, **kwargs)
+
+        page_cache.invalidate("posts")
+        with mock.patch("app.main.views.render_template", render_and_change):
+            self.assertIn("changed", self.client.get("/").get_data(as_text=True))
+        # the views share the session of the test, which missed the write
+        db.session.expire_all()
+        self.assertIn("raced", self.client.get("/").get_data(as_text=True))
+
+        # logged in users always get a freshly rendered page
+        db.session.execute(Post.__table__.update().values(body_html="fresh"))
+        db.session.commit()
+        self.assertIn("raced", self.client.get("/").get_data(as_text=True))
+        self.client.post(
+            "/auth/login", data={"email": "joe@example.com", "password": "cat"}
+        )
+        self.assertIn("fresh", self.client.get("/").get_data(as_text=True))
+
+    def test_fragment_cache(self):
+        self.app.config["IBLOG_PAGE_CACHE"] = ""
+        page_cache.init_app(self.app)
+        u = User(
+            email="joe@example.com", username="joe", password="cat", confirmed=True
+        )
+        post = Post(body="original", author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        self.assertIn("original", self.client.get("/").get_data(as_text=True))
+        hits = fragment_cache.info()["hits"]
+
+        # the fragment is reused until the post changes
+        self.assertIn("original", self.client.get("/").get_data(as_text=True))
+        self.assertEqual(fragment_cache.info()["hits"], hits + 1)
+        # even when its body is rewritten without a version bump
+        db.session.execute(Post.__table__.update().values(body_html="changed"))
+        db.session.commit()
+        self.assertIn("changed", self.client.get("/").get_data(as_text=True))
+        post.body = "edited"
+        db.session.commit()
+        self.assertIn("edited", self.client.get("/").get_data(as_text=True))
+
+        # the author gets a variant with the Edit link
+        self.assertNotIn("/edit/", self.client.get("/").get_data(as_text=True))
+        self.client.post(
+            "/auth/login", data={"email": "joe@example.com", "password": "cat"}
+        )
+        self.assertIn("/edit/", self.client.get("/").get_data(as_text=True))
+
+    def test_search_page(self):
+        u = User(
+            email="joe@example.com", username="joe", password="cat", confirmed=True
+        )
+        post = Post(body="a post about teapots", author=u)
+        comment = Comment(body="lovely teapot", post=post, author=u)
+        db.session.add_all([u, post, comment])
+        db.session.commit()
+        data = self.client.get("/search?q=teapots").get_data(as_text=True)
+        self.assertIn("a post about teapots", data)
+        self.assertIn("lovely teapot", data)
+        self.assertIn("/posts/%d#comments" % post.id, data)
+        self.assertIn(
+            "No posts or comments match",
+            self.client.get("/search?q=kettle").get_data(as_text=True),
+        )
+
+        # rows written around the model events are found after a rebuild
+        db.session.execute(
+            Post.__table__.insert().values(body="kettle", author_id=u.id)
+        )
+        db.session.commit()
+        self.assertEqual(search.find("kettle", 10), ([], None))
+        search.rebuild()
+        db.session.commit()
+        hits, cursor = search.find("kettle", 10)
+        self.assertEqual([hit.kind for hit in hits], ["post"])
+
+    def test_server_timing(self):
+        self.assertNotIn("Server-Timing", self.client.get("/").headers)
+        self.app.config["IBLOG_SERVER_TIMING"] = True
+        u = User(
+            email="joe@example.com", username="joe", password="cat", confirmed=True
+        )
+        db.session.add(u)
+        db.session.commit()
+        with self.assertLogs("app.timing", "INFO") as logs:
+            self.client.post(
+                "/auth/login", data={"email": "joe@example.com", "password": "cat"}
+            )
+            response = self.client.post("/", data={"body": "*new* post"})
+        self.assertEqual(response.status_code, 302)
+        timing = response.headers["Server-Timing"]
+        for metric in ("db", "tpl", "md", "auth", "total"):
+            self.assertIn(metric + ";dur=", timing)
+        self.assertRegex(timing, r'desc="[1-9]\d* queries"')
+        self.assertIn("method=POST path=/ status=302", logs.output[-1])
+        # the password check of the login was timed
+        self.assertNotRegex(logs.output[0], r"auth_ms=0\.0\b")
+
+    def test_query_fingerprint(self):
+        self.assertEqual(
+            fingerprint(
+                "SELECT * FROM users\n WHERE id IN (?, ?, ?) AND name = 'o''k' "
+                "LIMIT 10"
+            ),
+            "SELECT * FROM users WHERE id IN (?, ...) AND name = ? LIMIT ?",
+        )
+
+    def test_query_stats(self):
+        admin = Role.query.filter_by(name="Administrator").first()
+        db.session.add_all(
+            [
+                User(
+                    email="joe@example.com",
+                    username="joe",
+                    password="cat",
+                    confirmed=True,
+                ),
+                User(
+                    email="ann@example.com",
+                    username="ann",
+                    password="dog",
+                    confirmed=True,
+                    role=admin,
+                ),
+            ]
+        )
+        db.session.commit()
+        self.client.post(
+            "/auth/login", data={"email": "joe@example.com", "password": "cat"}
+        )
+        self.assertEqual(self.client.get("/admin/query-stats").status_code, 403)
+        self.assertEqual(self.client.get("/admin/query-stats.json").status_code, 403)
+        self.client.get("/auth/logout")
+
+        self.client.post(
+            "/auth/login", data={"email": "ann@example.com", "password": "dog"}
+        )
+        for _ in range(3):
+            self.client.get("/user/joe")
+        queries = self.client.get("/admin/query-stats.json").get_json()["queries"]
+        by_user = [
+            query for query in queries if query["endpoints"].get("main.user") == 3
+        ]
+        self.assertTrue(by_user)
+        self.assertEqual(queries, sorted(queries, key=lambda q: -q["total"]))
+        response = self.client.get("/admin/query-stats")
+        self.assertIn("main.user (3)", response.get_data(as_text=True))
+
+        response = self.client.post("/admin/query-stats", follow_redirects=True)
+        self.assertIn("have been reset", response.get_data(as_text=True))
+        self.assertEqual(
+            query_stats.report()[0][0]["endpoints"], {"main.query_stats_page": 1}
+        )
+
+    def test_sampling_profiler(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.app.config["IBLOG_PROFILER_DIR"] = tmp.name
+        self.app.config["IBLOG_PROFILER_INTERVAL"] = 0.0005
+        self.app.config["IBLOG_PROFILER_TOKEN"] = "secret"
+        admin = Role.query.filter_by(name="Administrator").first()
+        u = User(
+            email="ann@example.com",
+            username="ann",
+            password="dog",
+            confirmed=True,
+            role=admin,
+        )
+        db.session.add(u)
+        db.session.commit()
+        self.client.post(
+            "/auth/login", data={"email": "ann@example.com", "password": "dog"}
+        )
+        response = self.client.post(
+            "/admin/profiler",
+            data={"requests": 1, "endpoint": "main.user"},
+            follow_redirects=True,
+        )
+        self.assertIn("Armed for 1 more requests", response.get_data(as_text=True))
+
+        # only the next request of the armed endpoint is profiled
+        self.client.get("/")
+        self.assertEqual(os.listdir(tmp.name), [])
+        self.client.get("/user/ann")
+        self.client.get("/user/ann")
+        files = sorted(os.listdir(tmp.name))
+        self.assertEqual(len(files), 2)
+        collapsed, speedscope = files
+        self.assertIn("-main.user-", collapsed)
+        self.assertTrue(collapsed.endswith(".collapsed"))
+        with open(os.path.join(tmp.name, speedscope)) as f:
+            profile = json.load(f)["profiles"][0]
+        self.assertEqual(len(profile["samples"]), len(profile["weights"]))
+        with open(os.path.join(tmp.name, collapsed)) as f:
+            for line in f:
+                self.assertRegex(line, r"^\S.* \d+$")
+
+        # so is any request with the token
+        self.client.get("/", headers={"X-Profile": "secret"})
+        self.assertEqual(len(os.listdir(tmp.name)), 4)
+
+    def test_page_cache(self):
+        self.check_page_cache()
+
+    def test_shared_page_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.config["IBLOG_PAGE_CACHE"] = "sqlite"
+            self.app.config["IBLOG_PAGE_CACHE_PATH"] = os.path.join(tmp, "pages")
+            page_cache.init_app(self.app)
+            self.check_page_cache()
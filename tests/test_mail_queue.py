@@ -0,0 +1,161 @@
+import socketserver
+import threading
+import unittest
+from unittest import mock
+from app import create_app, db, mail, mail_queue
+from app.email import send_email
+from app.models import User
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    """Just enough of an SMTP server to count sessions and messages"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, refuse_sessions=0, reject_messages=0):
+        super().__init__(("127.0.0.1", 0), SMTPHandler)
+        self.sessions = 0
+        self.messages = []
+        # sessions closed right after connecting, to exercise the retries
+        self.refuse_sessions = refuse_sessions
+        # messages rejected at DATA, failing only themselves
+        self.reject_messages = reject_messages
+        self.lock = threading.Lock()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.sessions += 1
+            if server.refuse_sessions:
+                server.refuse_sessions -= 1
+                return
+        self.reply("220 stub ready")
+        while True:
+            line = self.rfile.readline().decode("utf-8").strip()
+            command = line[:4].upper()
+            if not line or command == "QUIT":
+                self.reply("221 bye")
+                return
+            if command == "DATA":
+                with server.lock:
+                    reject = server.reject_messages > 0
+                    server.reject_messages -= reject
+                if reject:
+                    self.reply("554 rejected")
+                    continue
+                self.reply("354 go ahead")
+                data = []
+                while True:
+                    line = self.rfile.readline().decode("utf-8")
+                    if line.rstrip("\r\n") == ".":
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append("".join(data))
+            self.reply("250 ok")
+
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        mail_queue.drain(5)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def use_stub(self, **kwargs):
+        stub = SMTPStub(**kwargs)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        self.addCleanup(stub.server_close)
+        self.addCleanup(stub.shutdown)
+        self.app.config.update(
+            MAIL_SERVER="127.0.0.1",
+            MAIL_PORT=stub.server_address[1],
+            MAIL_USE_TLS=False,
+            MAIL_USERNAME=None,
+            MAIL_SUPPRESS_SEND=False,
+            IBLOG_MAIL_WORKERS=1,
+            IBLOG_MAIL_RETRY_BACKOFF=0.01,
+        )
+        mail.init_app(self.app)
+        mail_queue.init_app(self.app)
+        return stub
+
+    def send(self, count):
+        user = User(email="john@example.com", username="john")
+        with self.app.test_request_context():
+            return [
+                send_email(
+                    "john@example.com", "Hi", "auth/email/confirm", user=user, token=i
+                )
+                for i in range(count)
+            ]
+
+    def test_batches_share_a_session(self):
+        stub = self.use_stub()
+        # queue messages before the worker is started
+        with mock.patch.object(mail_queue, "_start_workers"):
+            self.send(5)
+        self.assertEqual(mail_queue.info()["depth"], 5)
+        self.send(1)
+        self.assertEqual(mail_queue.drain(5), 0)
+        self.assertEqual(len(stub.messages), 6)
+        # the worker may have started on the first message of the queue
+        self.assertLessEqual(stub.sessions, 2)
+        info = mail_queue.info()
+        self.assertEqual(info["sent"], 6)
+        self.assertEqual(info["depth"], 0)
+
+    def test_retry(self):
+        stub = self.use_stub(refuse_sessions=2)
+        self.send(1)
+        self.assertEqual(mail_queue.drain(5), 0)
+        self.assertEqual(len(stub.messages), 1)
+        self.assertEqual(stub.sessions, 3)
+        self.assertEqual(mail_queue.info()["retries"], 2)
+
+    def test_give_up(self):
+        stub = self.use_stub(refuse_sessions=10)
+        self.app.config["IBLOG_MAIL_RETRIES"] = 1
+        self.send(1)
+        mail_queue.drain(5)
+        self.assertEqual(stub.messages, [])
+        self.assertEqual(mail_queue.info()["failed"], 1)
+
+    def test_rejected_message(self):
+        stub = self.use_stub(reject_messages=1)
+        with mock.patch.object(mail_queue, "_start_workers"):
+            self.send(2)
+        self.send(1)
+        self.assertEqual(mail_queue.drain(5), 0)
+        self.assertEqual(len(stub.messages), 2)
+        self.assertLessEqual(stub.sessions, 2)
+        info = mail_queue.info()
+        self.assertEqual(info["failed"], 1)
+        self.assertEqual(info["sent"], 2)
+        self.assertEqual(info["retries"], 0)
+
+    def test_backpressure(self):
+        self.use_stub()
+        self.app.config.update(IBLOG_MAIL_QUEUE_SIZE=1, IBLOG_MAIL_QUEUE_TIMEOUT=0.01)
+        mail_queue.init_app(self.app)
+        with mock.patch.object(mail_queue, "_start_workers"):
+            self.assertEqual(self.send(2), [True, False])
+        info = mail_queue.info()
+        self.assertEqual(info["depth"], 1)
+        self.assertEqual(info["dropped"], 1)
+        # a started worker makes room again
+        self.app.config["IBLOG_MAIL_QUEUE_TIMEOUT"] = 5
+        self.assertEqual(self.send(1), [True])
+        self.assertEqual(mail_queue.drain(5), 0)
@@ -1,8 +1,20 @@
+import math
 import unittest
-from app.models import User, Permission, AnonymousUser, Role, Follow
-from app import db, create_app
+from app.models import (
+    User,
+    Permission,
+    AnonymousUser,
+    Role,
+    Follow,
+    Post,
+    PostScore,
+    Comment,
+    TimelineEntry,
+    load_user,
+)
+from app import db, create_app, fake, last_seen_buffer, user_cache, render_cache
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -162,6 +174,32 @@ class UserModelTestCase(unittest.TestCase):
         u.ping()
         self.assertTrue(u.last_seen > last_seen_before)
 
+    def test_ping_is_buffered(self):
+        self.app.config["IBLOG_LAST_SEEN_FLUSH_INTERVAL"] = 3600
+        u = User(password="Cat")
+        db.session.add(u)
+        db.session.commit()
+
+        def stored_last_seen():
+            return db.session.execute(
+                db.select(User.__table__.c.last_seen).where(User.id == u.id)
+            ).scalar()
+
+        last_seen_before = stored_last_seen()
+        time.sleep(0.01)
+        u.ping()
+        u.ping()
+        self.assertTrue(u.last_seen > last_seen_before)
+        self.assertEqual(stored_last_seen(), last_seen_before)
+        self.assertEqual(last_seen_buffer.pending(), 1)
+        self.assertEqual(last_seen_buffer.flush(), 1)
+        self.assertEqual(stored_last_seen(), u.last_seen)
+
+        # recent enough values are not written again
+        self.app.config["IBLOG_LAST_SEEN_RESOLUTION"] = 60
+        u.ping()
+        self.assertEqual(last_seen_buffer.pending(), 0)
+
     def test_gravatar(self):
         u = User(email="test1@example.com", password="Cat")
         with self.app.test_request_context("/"):
@@ -217,3 +255,298 @@ class UserModelTestCase(unittest.TestCase):
         db.session.delete(u2)
         db.session.commit()
         self.assertTrue(Follow.query.count() == 1)
+
+    def test_counters(self):
+        u1 = User(email="test1@test.com", password="cat1")
+        u2 = User(email="test2@test.com", password="cat2")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        # everyone follows themselves
+        self.assertEqual(u1.follower_count, 1)
+        self.assertEqual(u1.followed_count, 1)
+
+        u1.follow(u2)
+        post = Post(body="post", author=u2)
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 2)
+        self.assertEqual(u2.follower_count, 2)
+        self.assertEqual(u2.post_count, 1)
+
+        comment = Comment(body="comment", author=u1, post=post)
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(post.comment_count, 1)
+
+        db.session.delete(comment)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(post.comment_count, 0)
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u2.follower_count, 1)
+
+    def test_recount(self):
+        u = User(email="test1@test.com", password="cat1")
+        post = Post(body="post", author=u)
+        db.session.add_all([u, post, Comment(body="comment", author=u, post=post)])
+        db.session.commit()
+        db.session.execute(
+            User.__table__.update().values(
+                post_count=0, follower_count=0, followed_count=0
+            )
+        )
+        db.session.execute(Post.__table__.update().values(comment_count=0))
+        db.session.commit()
+
+        User.recount()
+        Post.recount()
+        db.session.commit()
+        self.assertEqual(u.post_count, 1)
+        self.assertEqual(u.follower_count, 1)
+        self.assertEqual(u.followed_count, 1)
+        self.assertEqual(post.comment_count, 1)
+
+    def test_bulk_fake(self):
+        def generate():
+            fake.bulk(users=20, posts=50, comments=30, follows=60, seed=1)
+            return (
+                [u.username for u in User.query.order_by(User.id)],
+                db.session.query(Follow.follower_id, Follow.followed_id)
+                .order_by(Follow.follower_id, Follow.followed_id)
+                .all(),
+            )
+
+        usernames, follows = generate()
+        self.assertEqual(len(usernames), 20)
+        # 60 follows on top of the self follows, without duplicates
+        self.assertEqual(len(follows), 80)
+        self.assertEqual(len(set(follows)), 80)
+        self.assertEqual(Post.query.count(), 50)
+        self.assertEqual(Comment.query.count(), 30)
+        # counters and timelines are in step with the inserted rows
+        self.assertEqual(sum(u.post_count for u in User.query), 50)
+        self.assertEqual(sum(p.comment_count for p in Post.query), 30)
+        self.assertEqual(sum(u.follower_count for u in User.query), 80)
+        u = User.query.first()
+        self.assertEqual(
+            u.followed_posts.count(),
+            Post.query.join(Follow, Follow.followed_id == Post.author_id)
+            .filter(Follow.follower_id == u.id)
+            .count(),
+        )
+
+        # the same seed generates the same data
+        db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+        self.assertEqual(generate(), (usernames, follows))
+
+    def test_add_self_follows(self):
+        u1 = User(email="test1@test.com", password="cat1")
+        u2 = User(email="test2@test.com", password="cat2")
+        db.session.add_all([u1, u2, Post(body="post", author=u2)])
+        db.session.commit()
+        # as if u2 had been created before users followed themselves
+        db.session.delete(u2.followed.filter_by(followed_id=u2.id).first())
+        db.session.commit()
+        self.assertEqual(u2.followed_posts.count(), 0)
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            User.add_self_follows()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", count)
+        # the same statements whatever the number of users
+        self.assertEqual(len(statements), 3)
+        db.session.expire_all()
+        self.assertTrue(u1.is_following(u1))
+        self.assertTrue(u2.is_following(u2))
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(u2.followed_count, 1)
+        self.assertEqual(u1.follower_count, 1)
+        self.assertEqual(u2.followed_posts.count(), 1)
+
+        # running it again changes nothing
+        User.add_self_follows()
+        self.assertEqual(Follow.query.count(), 2)
+        self.assertEqual(TimelineEntry.query.count(), 1)
+
+    def test_insert_roles_is_idempotent(self):
+        permissions = {r.name: r.permissions for r in Role.query}
+        Role.insert_roles()
+        self.assertEqual({r.name: r.permissions for r in Role.query}, permissions)
+        self.assertEqual(Role.query.filter_by(default=True).count(), 1)
+
+    def test_timeline(self):
+        u1 = User(email="test1@test.com", password="cat1")
+        u2 = User(email="test2@test.com", password="cat2")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p1 = Post(body="before follow", author=u2)
+        db.session.add(p1)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [])
+
+        # following backfills, new posts are fanned out
+        u1.follow(u2)
+        db.session.commit()
+        p2 = Post(body="after follow", author=u2)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [p2, p1])
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 2)
+        self.assertEqual(
+            {e.timestamp for e in TimelineEntry.query.filter_by(user_id=u1.id)},
+            {p1.timestamp, p2.timestamp},
+        )
+
+        # the page is a range scan of the timeline index, without a sort
+        query = u1.followed_posts.limit(10).statement.compile(
+            db.engine, compile_kwargs={"literal_binds": True}
+        )
+        plan = " ".join(
+            row[-1]
+            for row in db.session.execute(db.text("EXPLAIN QUERY PLAN %s" % query))
+        )
+        self.assertIn("ix_timeline_entries_user_timestamp", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+        # unfollowing prunes
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [])
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 0)
+
+    def test_post_scores(self):
+        u = User(email="test1@test.com", password="cat1")
+        now = datetime.utcnow()
+        old = Post(body="old", author=u, timestamp=now - timedelta(hours=48))
+        new = Post(body="new", author=u, timestamp=now)
+        db.session.add_all([u, old, new])
+        db.session.commit()
+        self.assertEqual(PostScore.trending_posts().all(), [new, old])
+
+        # five comments today outweigh the two days the old post lost
+        for i in range(5):
+            db.session.add(Comment(body="c%d" % i, post=old, author=u))
+        db.session.commit()
+        self.assertEqual(PostScore.trending_posts().all(), [old, new])
+        score = db.session.get(PostScore, old.id).score
+        self.assertAlmostEqual(
+            score,
+            math.log(2**-2 + 5) + PostScore.term(now),
+            places=3,
+        )
+
+        # compaction recomputes the same scores and forgets old activity
+        self.assertEqual(PostScore.compact(now), 2)
+        self.assertAlmostEqual(db.session.get(PostScore, old.id).score, score, 3)
+        self.assertEqual(PostScore.compact(now + timedelta(days=8)), 0)
+        self.assertEqual(PostScore.trending_posts().all(), [])
+
+    def test_timeline_merges_popular_authors(self):
+        # with a limit of 1 only self follows are fanned out
+        self.app.config["IBLOG_TIMELINE_FANOUT_LIMIT"] = 1
+        u1 = User(email="test1@test.com", password="cat1")
+        u2 = User(email="test2@test.com", password="cat2")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        p = Post(body="popular", author=u2)
+        db.session.add(p)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(post_id=p.id).count(), 0)
+        self.assertEqual(u1.followed_posts.all(), [p])
+        self.assertEqual(u2.followed_posts.all(), [p])
+
+        # dropping back to the limit fans the author's posts back out
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(post_id=p.id).count(), 1)
+        self.assertEqual(u2.followed_posts.all(), [p])
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.filter_by(post_id=p.id).count(), 1)
+
+    def test_user_loader_cache(self):
+        u = User(email="test1@test.com", username="test", password="cat")
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        self.assertEqual(load_user(str(user_id)), u)
+        self.assertIsNotNone(user_cache.get(user_id))
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        db.session.expunge_all()
+        db.event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            cached = load_user(str(user_id))
+            self.assertEqual(cached.username, "test")
+            self.assertTrue(cached.can(Permission.WRITE))
+            self.assertFalse(cached.is_administrator())
+            cached.gravatar()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", count)
+        self.assertEqual(statements, [])
+
+        # columns outside of the snapshot are still available
+        self.assertEqual(cached.email, "test1@test.com")
+
+        # modifying the user drops the snapshot
+        cached.name = "Test"
+        db.session.commit()
+        self.assertIsNone(user_cache.get(user_id))
+
+    def test_render_cache(self):
+        p1 = Post(body="*same* body")
+        p2 = Post(body="*same* body")
+        self.assertEqual(p1.body_html, "<p><em>same</em> body</p>")
+        self.assertEqual(p2.body_html, p1.body_html)
+        # comments are sanitized with their own profile
+        c = Comment(body="*same* body")
+        self.assertEqual(c.body_html, "<em>same</em> body")
+        info = render_cache.info()
+        self.assertEqual(info["misses"], 2)
+        self.assertEqual(info["hits"], 1)
+
+        # resending an unchanged body doesn't even look it up
+        p1.body = "*same* body"
+        self.assertEqual(render_cache.info()["hits"], 1)
+
+    def test_rerender(self):
+        from app.rendering import rerender
+
+        posts = [Post(body="*post* %d" % i) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        ids = sorted(post.id for post in posts)
+        db.session.execute(Post.__table__.update().values(body_html="stale"))
+        db.session.commit()
+
+        progress = []
+        changed = rerender(
+            Post,
+            "post",
+            workers=2,
+            batch_size=2,
+            after_id=ids[0],
+            progress=lambda done, last_id: progress.append((done, last_id)),
+        )
+        self.assertEqual(changed, 4)
+        self.assertEqual(progress, [(2, ids[2]), (4, ids[4])])
+        html = dict(db.session.query(Post.id, Post.body_html))
+        self.assertEqual(html[ids[0]], "stale")
+        self.assertEqual(html[ids[1]], "<p><em>post</em> 1</p>")
+        # nothing left to rewrite
+        self.assertEqual(rerender(Post, "post", after_id=ids[0]), 0)